@@ -2,36 +2,57 @@ import base64
 import io
 import json
 import os
+import time
+import uuid
 from typing import Any, Dict, List
 
-import chromadb
-import google.generativeai as palm
+import numpy as np
 import pandas as pd
 import requests
 import streamlit as st
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
-from langchain.text_splitter import (
-    RecursiveCharacterTextSplitter,
-    SentenceTransformersTokenTextSplitter,
-)
 from PIL import Image, ImageDraw, ImageFont
-from pypdf import PdfReader
-from transformers import pipeline
 
-from utils.cnn_transformer import *
+from utils import registry
+from utils.frame_cache import FrameCache, dhash
 from utils.helpers import *
+from utils.stream import boxes_to_array, overlay_boxes
 
 # API Key (You should set this in your environment variables)
 api_key = st.secrets["PALM_API_KEY"]
-palm.configure(api_key=api_key)
 
+# API Gateway endpoint of the Textract Lambda (lambda/my_textract.py)
+TEXTRACT_URL = "https://2tsig211e0.execute-api.us-east-1.amazonaws.com/my_textract"
 
-# Load YOLO pipeline
-yolo_pipe = pipeline("object-detection", model="hustvl/yolos-small")
+# Optionally start loading heavy models (e.g. WARM_UP_MODELS=yolo,embedding_function)
+# in the background so that the first page renders without waiting for them
+registry.warm_up_once()
+
+
+# Gemini error responses (quota, safety blocks, ...) have no candidates and
+# are not cached
+def has_candidates(response):
+    return isinstance(response, dict) and bool(response.get("candidates"))
+
+
+# Owner of the PDF corpus and of batched Gemini requests: the signed-in user
+# (st.login), otherwise this browser session, so that one visitor never sees
+# another's documents or shares a Gemini prompt with them
+def workspace_id():
+    user = getattr(st, "user", None)
+    if user is not None and user.get("is_logged_in"):
+        return "user:" + (user.get("sub") or user.get("email"))
+
+    if "workspace_id" not in st.session_state:
+        st.session_state["workspace_id"] = "session:" + uuid.uuid4().hex
+    return st.session_state["workspace_id"]
 
 
 # Function to draw bounding boxes and labels on image
 def draw_boxes(image, predictions):
+    # The outlines of all boxes are drawn at once on the pixel array
+    frame = overlay_boxes(np.array(image.convert("RGB")), boxes_to_array(predictions))
+    image = Image.fromarray(frame)
+
     draw = ImageDraw.Draw(image)
     font = ImageFont.load_default()
 
@@ -39,32 +60,118 @@ def draw_boxes(image, predictions):
         label = pred["label"]
         score = pred["score"]
         box = pred["box"]
-        xmin, ymin, xmax, ymax = box.values()
-        draw.rectangle([xmin, ymin, xmax, ymax], outline="red", width=2)
-        draw.text((xmin, ymin), f"{label} ({score:.2f})", fill="red", font=font)
+        draw.text(
+            (box["xmin"], box["ymin"]), f"{label} ({score:.2f})", fill="red", font=font
+        )
 
     return image
 
 
+# Stops the live stream's detection worker and forgets its analyzer
+def stop_live_analyzer():
+    analyzer = st.session_state.pop("live_analyzer", None)
+    if analyzer is not None:
+        analyzer.stop()
+
+
+# Live camera stream: YOLO on the latest frame, Gemini on keyframes only
+def run_live_stream():
+    try:
+        import av
+        from streamlit_webrtc import webrtc_streamer
+    except ImportError:
+        st.error("The live stream needs streamlit-webrtc: pip install streamlit-webrtc")
+        return
+
+    from utils.gemini_batch import response_text
+    from utils.stream import LiveAnalyzer
+
+    # The analyzer of this rerun, set once the stream is playing
+    current = {}
+
+    def video_frame_callback(frame):
+        array = frame.to_ndarray(format="rgb24")
+        analyzer = current.get("analyzer")
+        if analyzer is not None:
+            array = analyzer(array)
+        return av.VideoFrame.from_ndarray(array, format="rgb24")
+
+    ctx = webrtc_streamer(
+        key="live-stream",
+        video_frame_callback=video_frame_callback,
+        media_stream_constraints={"video": True, "audio": False},
+    )
+
+    # The detection worker only lives while the stream plays
+    if not ctx.state.playing:
+        stop_live_analyzer()
+        return
+
+    # One analyzer (and detection worker) per session
+    if "live_analyzer" not in st.session_state:
+        batcher = registry.get("gemini_batcher")
+        session = workspace_id()
+        st.session_state["live_analyzer"] = LiveAnalyzer(
+            detect=registry.get("yolo"),
+            describe=lambda image: batcher.submit(
+                convert_image_to_base64(resize_image(image)), session=session
+            ),
+        )
+    analyzer = current["analyzer"] = st.session_state["live_analyzer"]
+
+    # Refresh the latest Gemini answer and detections while the stream runs
+    placeholder = st.empty()
+    while ctx.state.playing:
+        with placeholder.container():
+            if analyzer.description is not None:
+                text = response_text(analyzer.description)
+                if text is not None:
+                    st.write(text)
+                else:
+                    st.warning("Check gemini's API.")
+            st.table(
+                pd.DataFrame(
+                    [
+                        {"label": p["label"], "score": p["score"]}
+                        for p in analyzer.predictions
+                    ]
+                )
+            )
+            st.caption(
+                f"Detection latency: {analyzer.detector.latency:.2f}s, "
+                f"dropped frames: {analyzer.detector.dropped}"
+            )
+        time.sleep(1)
+    stop_live_analyzer()
+
+
 # Main function of the Streamlit app
 def main():
     st.title("Generative AI Demo on Camera Input/Image/PDF 💻")
 
     # Dropdown for user to choose the input method
     input_method = st.sidebar.selectbox(
-        "Choose input method:", ["Camera", "Upload Image", "Upload PDF"]
+        "Choose input method:", ["Camera", "Live Stream", "Upload Image", "Upload PDF"]
     )
 
-    image, uploaded_file = None, None
+    image, uploaded_files = None, []
+    if input_method != "Live Stream":
+        stop_live_analyzer()
+
     if input_method == "Camera":
         # Streamlit widget to capture an image from the user's webcam
         image = st.sidebar.camera_input("Take a picture 📸")
+    elif input_method == "Live Stream":
+        # Continuous analysis of the webcam stream
+        run_live_stream()
     elif input_method == "Upload Image":
         # Create a file uploader in the sidebar
         image = st.sidebar.file_uploader("Upload a JPG image", type=["jpg"])
     elif input_method == "Upload PDF":
         # File uploader widget
-        uploaded_file = st.sidebar.file_uploader("Choose a PDF file", type="pdf")
+        uploaded_files = st.sidebar.file_uploader(
+            "Choose PDF files", type="pdf", accept_multiple_files=True
+        )
 
     # Add instruction
     st.sidebar.markdown(
@@ -100,28 +207,53 @@ def main():
         # Convert the resized image to base64
         image_base64 = convert_image_to_base64(resized_image)
 
+        # In Camera mode, the Gemini and YOLO results of a near-identical
+        # earlier shot in this session are reused instead of calling them again
+        frame_cache, frame_hash = None, None
+        if input_method == "Camera":
+            if "frame_cache" not in st.session_state:
+                st.session_state["frame_cache"] = FrameCache()
+            frame_cache = st.session_state["frame_cache"]
+            frame_hash = dhash(resized_image)
+
+        def cached(key, compute, should_cache=None):
+            if frame_cache is None:
+                return compute()
+            return frame_cache.get_or_compute(frame_hash, key, compute, should_cache)
+
         # OCR by API Call of AWS Textract via Post Method
         if input_method == "Upload Image":
             st.success("Running textract!")
-            url = "https://2tsig211e0.execute-api.us-east-1.amazonaws.com/my_textract"
-            payload = {"image": image_base64}
-            result_dict = post_request_and_parse_response(url, payload)
-            output_data = extract_line_items(result_dict)
-            df = pd.DataFrame(output_data)
-
+            result_dict = textract_document(
+                TEXTRACT_URL,
+                convert_image_to_bytes(resized_image),
+                s3_bucket=os.environ.get("TEXTRACT_BUCKET"),
+            )
             # Using an expander to hide the json
             with st.expander("Show/Hide Raw Json"):
                 st.write(result_dict)
 
-            # Using an expander to hide the table
-            with st.expander("Show/Hide Table"):
-                st.table(df)
+            try:
+                df = decode_columnar_response(result_dict)
+            except RuntimeError as e:
+                st.error(str(e))
+            else:
+                # Using an expander to hide the table
+                with st.expander("Show/Hide Table"):
+                    st.table(df)
 
         if api_key:
             # Make API call
             st.success("Running Gemini!")
             with st.spinner('Wait for it...'):
-                response = call_gemini_api(image_base64, api_key)
+                # Requests of this session are batched together
+                response = cached(
+                    "gemini",
+                    lambda: registry.get("gemini_batcher")
+                    .submit(image_base64, session=workspace_id())
+                    .result(),
+                    should_cache=has_candidates,
+                )
 
             with st.expander("Raw output from Gemini"):
                 st.write(response)
@@ -141,8 +273,12 @@ def main():
 
                 # Display the entered question
                 if input_prompt:
-                    updated_text_from_response = call_gemini_api(
-                        image_base64, api_key, prompt=input_prompt
+                    updated_text_from_response = cached(
+                        ("gemini", input_prompt),
+                        lambda: call_gemini_api(
+                            image_base64, api_key, prompt=input_prompt
+                        ),
+                        should_cache=has_candidates,
                     )
 
                     if updated_text_from_response is not None:
@@ -170,7 +306,7 @@ def main():
             image = Image.open(image)
             with st.spinner("Wait for it..."):
                 st.success("Running YOLO algorithm!")
-                predictions = yolo_pipe(image)
+                predictions = cached("yolo", lambda: registry.get("yolo")(image))
                 st.success("YOLO running successfully.")
 
             # Draw bounding boxes and labels
@@ -180,79 +316,70 @@ def main():
             # Display annotated image
             st.image(image_with_boxes, caption="Annotated Image", use_column_width=True)
 
-    # File uploader widget
-    if uploaded_file is not None:
-        # To read file as bytes:
-        bytes_data = uploaded_file.getvalue()
-        st.success("Your PDF is uploaded successfully.")
+    # PDF corpus: every uploaded document stays searchable for this user
+    if input_method == "Upload PDF":
+        from pypdf import PdfReader
 
-        # Get the file name
-        file_name = uploaded_file.name
+        from utils.corpus import document_id_for
 
-        # Save the file temporarily
-        with open(file_name, "wb") as f:
-            f.write(uploaded_file.getbuffer())
+        corpus = registry.get("corpus")
+        user_id = workspace_id()
 
-        # Display PDF
-        # displayPDF(file_name)
+        for uploaded_file in uploaded_files:
+            # To read file as bytes:
+            bytes_data = uploaded_file.getvalue()
+            document_id = document_id_for(bytes_data)
+            if corpus.has_document(user_id, document_id):
+                continue
 
-        # Read file
-        reader = PdfReader(file_name)
-        pdf_texts = [p.extract_text().strip() for p in reader.pages]
+            # Read file
+            reader = PdfReader(io.BytesIO(bytes_data))
 
-        # Filter the empty strings
-        pdf_texts = [text for text in pdf_texts if text]
-        st.success("PDF extracted successfully.")
+            # Pages without extractable text (scans) are sent to Textract
+            pdf_texts = extract_pdf_texts(reader, TEXTRACT_URL)
 
-        # Split the texts
-        character_splitter = RecursiveCharacterTextSplitter(
-            separators=["\n\n", "\n", ". ", " ", ""], chunk_size=1000, chunk_overlap=0
-        )
-        character_split_texts = character_splitter.split_text("\n\n".join(pdf_texts))
-        st.success("Texts splitted successfully.")
-
-        # Tokenize it
-        st.warning("Start tokenzing ...")
-        token_splitter = SentenceTransformersTokenTextSplitter(
-            chunk_overlap=0, tokens_per_chunk=256
-        )
-        token_split_texts = []
-        for text in character_split_texts:
-            token_split_texts += token_splitter.split_text(text)
-        st.success("Tokenized successfully.")
-
-        # Add to vector database
-        embedding_function = SentenceTransformerEmbeddingFunction()
-        chroma_client = chromadb.Client()
-        chroma_collection = chroma_client.create_collection(
-            "tmp", embedding_function=embedding_function
-        )
-        ids = [str(i) for i in range(len(token_split_texts))]
-        chroma_collection.add(ids=ids, documents=token_split_texts)
-        st.success("Vector database loaded successfully.")
-
-        # User input
-        query = st.text_input("Ask me anything!", "What is the document about?")
-        results = chroma_collection.query(query_texts=[query], n_results=5)
-        retrieved_documents = results["documents"][0]
-        results_as_table = pd.DataFrame(
-            {
-                "ids": results["ids"][0],
-                "documents": results["documents"][0],
-                "distances": results["distances"][0],
-            }
-        )
-
-        # API of a foundation model
-        output = rag(query=query, retrieved_documents=retrieved_documents)
-        st.write(output)
-        st.success(
-            "Please see where the chatbot got the information from the document below.👇"
-        )
-        with st.expander("Raw query outputs:"):
-            st.write(results)
-        with st.expander("Processed tabular form query outputs:"):
-            st.table(results_as_table)
+            # Split, tokenize and add to the vector database
+            with st.spinner(f"Indexing {uploaded_file.name}..."):
+                n_chunks = corpus.add_document(
+                    user_id, document_id, uploaded_file.name, pdf_texts
+                )
+            st.success(f"{uploaded_file.name} indexed successfully ({n_chunks} chunks).")
+
+        documents = corpus.list_documents(user_id)
+        if documents:
+            # Optionally restrict the question to some of the documents
+            selected = st.multiselect(
+                "Search in:",
+                options=list(documents),
+                format_func=lambda document_id: documents[document_id]["name"],
+            )
+
+            # User input
+            query = st.text_input("Ask me anything!", "What is the document about?")
+            results = corpus.query(
+                user_id, query, n_results=5, document_ids=selected or None
+            )
+            retrieved_documents = results["documents"][0]
+            results_as_table = pd.DataFrame(
+                {
+                    "ids": results["ids"][0],
+                    "document": [m["document_name"] for m in results["metadatas"][0]],
+                    "page": [m["page"] for m in results["metadatas"][0]],
+                    "documents": results["documents"][0],
+                    "distances": results["distances"][0],
+                }
+            )
+
+            # API of a foundation model
+            output = rag(query=query, retrieved_documents=retrieved_documents)
+            st.write(output)
+            st.success(
+                "Please see where the chatbot got the information from the documents below.👇"
+            )
+            with st.expander("Raw query outputs:"):
+                st.write(results)
+            with st.expander("Processed tabular form query outputs:"):
+                st.table(results_as_table)
 
 
 if __name__ == "__main__":
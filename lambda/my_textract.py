@@ -4,7 +4,11 @@ An AWS lambda function that analyzes documents with Amazon Textract.
 """
 import json
 import base64
+import gzip
 import logging
+import os
+import time
+import uuid
 import boto3
 
 from botocore.exceptions import ClientError
@@ -12,8 +16,199 @@ from botocore.exceptions import ClientError
 # Set up logging.
 logger = logging.getLogger(__name__)
 
-# Get the boto3 client.
+# Get the boto3 clients.
 textract_client = boto3.client("textract")
+s3_client = boto3.client("s3")
+
+# Largest document Textract accepts as raw bytes in a synchronous call. Behind
+# API Gateway the 6 MB event limit keeps bodies under about 4.3 MB, so only
+# direct invocations can send more
+SYNC_BYTES_LIMIT = 5 * 1024 * 1024
+
+# Bucket used to stage binary documents for asynchronous jobs
+STAGING_BUCKET = os.environ.get("TEXTRACT_STAGING_BUCKET")
+
+# Seconds between two polls of an asynchronous Textract job
+POLL_INTERVAL = float(os.environ.get("TEXTRACT_POLL_INTERVAL", "1.0"))
+
+# Stop polling when less than this many milliseconds of the invocation are left
+POLL_TIME_MARGIN_MS = 3000
+
+# Seconds after the start of the invocation at which polling stops anyway:
+# API Gateway ends the integration after 29 seconds, whatever the Lambda timeout
+POLL_TIME_BUDGET = float(os.environ.get("TEXTRACT_POLL_TIME_BUDGET", "25"))
+
+# Fields returned for each block when the request carries a projection
+DEFAULT_PROJECTION_FIELDS = ["Text", "Confidence", "BoundingBox"]
+
+# Keys of the bounding box, flattened into "BoundingBox.<key>" columns
+BOUNDING_BOX_KEYS = ["Width", "Height", "Left", "Top"]
+
+
+def project_blocks(blocks, block_types=None, fields=None):
+    """
+    Selects blocks by type and returns the requested fields as columns.
+    param: blocks: The list of Block objects returned by Textract.
+    param: block_types: The block types to keep (e.g. ["LINE"]), all if None.
+    param: fields: The block fields to return. "BoundingBox" is flattened
+    into one column per key of the box.
+    return: A dictionary mapping each column name to a list of values.
+    """
+    if fields is None:
+        fields = DEFAULT_PROJECTION_FIELDS
+    if block_types is not None:
+        blocks = [block for block in blocks if block.get("BlockType") in block_types]
+
+    columns = {}
+    for field in fields:
+        if field == "BoundingBox":
+            boxes = [
+                block.get("Geometry", {}).get("BoundingBox", {}) for block in blocks
+            ]
+            for key in BOUNDING_BOX_KEYS:
+                columns[f"BoundingBox.{key}"] = [box.get(key) for box in boxes]
+        else:
+            columns[field] = [block.get(field) for block in blocks]
+
+    return columns
+
+
+def encode_columns(columns, compress=False):
+    """
+    Builds the columnar response body.
+    param: columns: The columns returned by project_blocks.
+    param: compress: Whether to gzip the columns (sent base64 encoded).
+    return: The response body as a dictionary.
+    """
+    count = len(next(iter(columns.values()), []))
+    body = {"format": "columnar", "count": count}
+
+    if compress:
+        raw = json.dumps(columns, separators=(",", ":")).encode("utf-8")
+        body["encoding"] = "gzip"
+        body["data"] = base64.b64encode(gzip.compress(raw)).decode("utf-8")
+    else:
+        body["encoding"] = "identity"
+        body["columns"] = columns
+
+    return body
+
+
+class BinaryBodyError(ValueError):
+    """
+    Raised when a raw binary body reaches the Lambda as text, i.e. API Gateway
+    has no binary media type for it. Clients fall back to base64 JSON.
+    """
+
+
+def parse_request(event):
+    """
+    Reads the request options and the document source from the event.
+    param: event: The event object for the Lambda function. The document is
+    either a raw binary body (API Gateway with isBase64Encoded), a JSON body
+    with a base64 "image", a JSON body or direct event with an "S3Object", or
+    a "JobId" of a previously started asynchronous job.
+    return: The request options and the Textract Document (None for a JobId).
+    """
+    body = event.get("body")
+    headers = {key.lower(): value for key, value in (event.get("headers") or {}).items()}
+    content_type = headers.get("content-type", "application/json")
+
+    if body is not None and not content_type.startswith("application/json"):
+        # Raw binary body, options come from the query string
+        params = event.get("queryStringParameters") or {}
+        request = {}
+        if "block_types" in params or "fields" in params:
+            request["projection"] = {
+                "block_types": params["block_types"].split(",")
+                if "block_types" in params
+                else None,
+                "fields": params["fields"].split(",") if "fields" in params else None,
+            }
+        request["compress"] = params.get("compress", "false").lower() == "true"
+        request["async"] = params.get("async", "false").lower() == "true"
+        if not event.get("isBase64Encoded"):
+            raise BinaryBodyError(
+                "Binary body received as text. Add the content type to the binary media types of the API Gateway."
+            )
+        return request, {"Bytes": base64.b64decode(body)}
+
+    request = json.loads(body) if body is not None else event
+
+    if "JobId" in request:
+        return request, None
+
+    if "image" in request:
+        # Decode the image
+        image_bytes = request["image"].encode("utf-8")
+        img_b64decoded = base64.b64decode(image_bytes)
+        return request, {"Bytes": img_b64decoded}
+
+    if "S3Object" in request:
+        return request, {
+            "S3Object": {
+                "Bucket": request["S3Object"]["Bucket"],
+                "Name": request["S3Object"]["Name"],
+            }
+        }
+
+    raise ValueError(
+        "Invalid source. Only image bytes, base 64 encoded image bytes, S3Object or JobId are supported."
+    )
+
+
+def stage_document(document_bytes):
+    """
+    Uploads a binary document to the staging bucket so that it can be analyzed
+    by an asynchronous job.
+    param: document_bytes: The document content.
+    return: The S3Object of the staged document.
+    """
+    if STAGING_BUCKET is None:
+        raise ValueError(
+            "Asynchronous jobs read documents from S3. Send it as an S3Object or set TEXTRACT_STAGING_BUCKET."
+        )
+    name = f"textract-staging/{uuid.uuid4()}"
+    s3_client.put_object(Bucket=STAGING_BUCKET, Key=name, Body=document_bytes)
+    return {"Bucket": STAGING_BUCKET, "Name": name}
+
+
+def get_async_blocks(job_id, context, deadline):
+    """
+    Polls an asynchronous text detection job and collects every result page.
+    param: job_id: The JobId returned by start_document_text_detection.
+    param: context: The context object for the lambda function, used to stop
+    polling before the invocation times out.
+    param: deadline: The time.monotonic() at which polling stops, so that the
+    caller gets the JobId before API Gateway times out.
+    return: The job status and, once it has succeeded, the list of Blocks.
+    """
+    while True:
+        response = textract_client.get_document_text_detection(JobId=job_id)
+        status = response["JobStatus"]
+        if status != "IN_PROGRESS":
+            break
+        if (
+            context.get_remaining_time_in_millis() < POLL_TIME_MARGIN_MS
+            or time.monotonic() + POLL_INTERVAL > deadline
+        ):
+            return status, None
+        time.sleep(POLL_INTERVAL)
+
+    if status == "FAILED":
+        raise ValueError(
+            "Textract job {} failed: {}".format(job_id, response.get("StatusMessage"))
+        )
+
+    # Follow the pagination of the results
+    blocks = response["Blocks"]
+    while "NextToken" in response:
+        response = textract_client.get_document_text_detection(
+            JobId=job_id, NextToken=response["NextToken"]
+        )
+        blocks.extend(response["Blocks"])
+
+    return status, blocks
 
 
 def lambda_handler(event, context):
@@ -30,37 +225,55 @@ def lambda_handler(event, context):
 
     # return message
 
+    started = time.monotonic()
     try:
         # Determine document source.
-        # event['image'] = event["queryStringParameters"]['image']
-        # event['image'] = json.loads(event['body'])["queryStringParameters"]['image']
-        event["image"] = json.loads(event["body"])["image"]
-        if "image" in event:
-            # Decode the image
-            image_bytes = event["image"].encode("utf-8")
-            img_b64decoded = base64.b64decode(image_bytes)
-            image = {"Bytes": img_b64decoded}
-
-        elif "S3Object" in event:
-            image = {
-                "S3Object": {
-                    "Bucket": event["S3Object"]["Bucket"],
-                    "Name": event["S3Object"]["Name"],
-                }
-            }
+        request, document = parse_request(event)
 
-        else:
-            raise ValueError(
-                "Invalid source. Only image base 64 encoded image bytes or S3Object are supported."
-            )
+        # Asynchronous jobs only read from S3, so large or multi-page binary
+        # documents are staged there first
+        if document is not None and "Bytes" in document:
+            if len(document["Bytes"]) > SYNC_BYTES_LIMIT or request.get("async"):
+                document = {"S3Object": stage_document(document["Bytes"])}
+                request["async"] = True
 
-        # Analyze the document.
-        response = textract_client.detect_document_text(Document=image)
+        if document is None or request.get("async"):
+            # Multi-page or large documents go through an asynchronous job
+            job_id = request.get("JobId")
+            if job_id is None:
+                job = textract_client.start_document_text_detection(
+                    DocumentLocation=document
+                )
+                job_id = job["JobId"]
+            status, blocks = get_async_blocks(
+                job_id, context, started + POLL_TIME_BUDGET
+            )
+        else:
+            # Analyze the document.
+            response = textract_client.detect_document_text(Document=document)
 
-        # Get the Blocks
-        blocks = response["Blocks"]
+            # Get the Blocks
+            blocks = response["Blocks"]
 
-        lambda_response = {"statusCode": 200, "body": json.dumps(blocks)}
+        # Return only the requested block types and fields, column by column,
+        # when the request carries a projection; otherwise every Block as before
+        projection = request.get("projection")
+        if blocks is None:
+            # The job is still running, the caller polls again with its JobId
+            lambda_response = {
+                "statusCode": 202,
+                "body": {"JobId": job_id, "JobStatus": status},
+            }
+        elif projection is not None:
+            columns = project_blocks(
+                blocks,
+                block_types=projection.get("block_types"),
+                fields=projection.get("fields"),
+            )
+            body = encode_columns(columns, compress=request.get("compress", False))
+            lambda_response = {"statusCode": 200, "body": body}
+        else:
+            lambda_response = {"statusCode": 200, "body": json.dumps(blocks)}
 
     except ClientError as err:
         error_message = "Couldn't analyze image. " + err.response["Error"]["Message"]
@@ -79,7 +292,10 @@ def lambda_handler(event, context):
     except ValueError as val_error:
         lambda_response = {
             "statusCode": 400,
-            "body": {"Error": "ValueError", "ErrorMessage": format(val_error)},
+            "body": {
+                "Error": type(val_error).__name__,
+                "ErrorMessage": format(val_error),
+            },
         }
         logger.error(
             "Error function %s: %s", context.invoked_function_arn, format(val_error)
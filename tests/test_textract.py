@@ -0,0 +1,288 @@
+"""
+Runs the Textract client (utils/textract.py) against the Lambda
+(lambda/my_textract.py) under moto, with requests.post routed into
+lambda_handler the way API Gateway would call it.
+"""
+import base64
+import importlib.util
+import json
+from pathlib import Path
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from utils import textract
+
+LAMBDA_PATH = Path(__file__).resolve().parents[1] / "lambda" / "my_textract.py"
+
+DOCUMENT = b"\xff\xd8fake-jpeg"
+
+
+class Context:
+    invoked_function_arn = "arn:aws:lambda:us-east-1:123456789012:function:my_textract"
+
+    def __init__(self, remaining_ms=60000):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+class Response:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.status_code = status_code
+
+
+class Gateway:
+    """
+    Stands in for API Gateway: turns requests.post calls into Lambda events,
+    with or without binary media types, and records the route of each call.
+    """
+
+    def __init__(self, lambda_module, binary_media_types=True):
+        self.lambda_module = lambda_module
+        self.binary_media_types = binary_media_types
+        self.calls = []
+        self.reply = None
+
+    def post(self, url, data=None, params=None, headers=None, **kwargs):
+        payload = kwargs.get("json")
+        self.calls.append("json" if payload is not None else "binary")
+        if self.reply is not None:
+            return self.reply
+
+        if payload is not None:
+            event = {
+                "body": json.dumps(payload),
+                "headers": {"Content-Type": "application/json"},
+            }
+        elif self.binary_media_types:
+            event = {
+                "body": base64.b64encode(data).decode("utf-8"),
+                "isBase64Encoded": True,
+                "headers": headers,
+                "queryStringParameters": params,
+            }
+        else:
+            # Without binary media types the raw body is passed on as text
+            event = {
+                "body": data.decode("latin-1"),
+                "isBase64Encoded": False,
+                "headers": headers,
+                "queryStringParameters": params,
+            }
+        http_response = self.lambda_module.lambda_handler(event, Context())
+        return Response(http_response["body"].encode("utf-8"))
+
+
+def detected_lines(texts, next_token=None):
+    response = {
+        "JobStatus": "SUCCEEDED",
+        "Blocks": [
+            {
+                "BlockType": "LINE",
+                "Text": text,
+                "Confidence": 99.0,
+                "Geometry": {
+                    "BoundingBox": {"Width": 0.5, "Height": 0.1, "Left": 0, "Top": 0}
+                },
+            }
+            for text in texts
+        ],
+    }
+    if next_token is not None:
+        response["NextToken"] = next_token
+    return response
+
+
+@pytest.fixture
+def lambda_module(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("TEXTRACT_STAGING_BUCKET", "staging")
+    monkeypatch.setenv("TEXTRACT_POLL_INTERVAL", "0")
+
+    with mock_aws():
+        boto3.client("s3").create_bucket(Bucket="staging")
+        boto3.client("s3").create_bucket(Bucket="uploads")
+
+        spec = importlib.util.spec_from_file_location("my_textract", LAMBDA_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        yield module
+
+
+@pytest.fixture
+def gateway(lambda_module, monkeypatch):
+    gateway = Gateway(lambda_module)
+    monkeypatch.setattr(textract.requests, "post", gateway.post)
+    monkeypatch.setattr(textract, "_textract_binary_unsupported", set())
+    monkeypatch.setattr(textract, "TEXTRACT_POLL_INTERVAL", 0)
+    return gateway
+
+
+def test_binary_body(gateway):
+    result = textract.textract_document("https://api/textract", DOCUMENT)
+    df = textract.decode_columnar_response(result)
+
+    assert gateway.calls == ["binary"]
+    assert list(df.columns) == [
+        "Text",
+        "Confidence",
+        "BoundingBox.Width",
+        "BoundingBox.Height",
+        "BoundingBox.Left",
+        "BoundingBox.Top",
+    ]
+
+
+def test_base64_fallback_is_remembered(gateway):
+    gateway.binary_media_types = False
+
+    textract.textract_document("https://api/textract", DOCUMENT)
+    textract.textract_document("https://api/textract", DOCUMENT)
+
+    assert gateway.calls == ["binary", "json", "json"]
+
+
+@pytest.mark.parametrize(
+    "reply",
+    [
+        Response(b'{"message": "Request Too Long"}', 413),
+        Response(b'{"message": "Endpoint request timed out"}', 504),
+    ],
+)
+def test_gateway_errors_are_raised_and_not_remembered(gateway, reply):
+    gateway.reply = reply
+
+    result = textract.textract_document("https://api/textract", DOCUMENT)
+    with pytest.raises(RuntimeError, match=json.loads(reply.content)["message"]):
+        textract.decode_columnar_response(result)
+
+    assert gateway.calls == ["binary"]
+    assert textract._textract_binary_unsupported == set()
+
+
+def test_non_json_reply_is_raised(gateway):
+    gateway.reply = Response(b"<html>Bad Gateway</html>", 502)
+
+    with pytest.raises(RuntimeError, match="502"):
+        textract.textract_document("https://api/textract", DOCUMENT)
+
+
+def test_large_document_requires_s3_bucket(gateway):
+    document = b"\0" * (textract.TEXTRACT_BINARY_LIMIT + 1)
+
+    with pytest.raises(ValueError, match="s3_bucket"):
+        textract.textract_document("https://api/textract", document)
+    assert gateway.calls == []
+
+
+def test_large_document_is_uploaded_to_s3(gateway, lambda_module, monkeypatch):
+    monkeypatch.setattr(
+        lambda_module.textract_client,
+        "get_document_text_detection",
+        lambda JobId, NextToken=None: detected_lines(["large"]),
+    )
+    document = b"\0" * (textract.TEXTRACT_BINARY_LIMIT + 1)
+
+    result = textract.textract_document(
+        "https://api/textract", document, s3_bucket="uploads"
+    )
+
+    assert gateway.calls == ["json"]
+    assert list(textract.decode_columnar_response(result)["Text"]) == ["large"]
+    uploads = boto3.client("s3").list_objects_v2(Bucket="uploads")["Contents"]
+    assert uploads[0]["Size"] == len(document)
+
+
+def test_multi_page_binary_is_staged(gateway, lambda_module, monkeypatch):
+    started = []
+    start = lambda_module.textract_client.start_document_text_detection
+
+    def start_document_text_detection(DocumentLocation):
+        started.append(DocumentLocation)
+        return start(DocumentLocation=DocumentLocation)
+
+    monkeypatch.setattr(
+        lambda_module.textract_client,
+        "start_document_text_detection",
+        start_document_text_detection,
+    )
+    monkeypatch.setattr(
+        lambda_module.textract_client,
+        "get_document_text_detection",
+        lambda JobId, NextToken=None: detected_lines(["page 1", "page 2"]),
+    )
+
+    result = textract.textract_document(
+        "https://api/textract", DOCUMENT, multi_page=True
+    )
+
+    assert started[0]["S3Object"]["Bucket"] == "staging"
+    assert list(textract.decode_columnar_response(result)["Text"]) == [
+        "page 1",
+        "page 2",
+    ]
+
+
+def test_running_job_returns_job_id(lambda_module, monkeypatch):
+    monkeypatch.setattr(
+        lambda_module.textract_client,
+        "get_document_text_detection",
+        lambda JobId, NextToken=None: {"JobStatus": "IN_PROGRESS"},
+    )
+
+    # Stops on the Lambda's remaining time
+    http_response = lambda_module.lambda_handler(
+        {"body": json.dumps({"JobId": "job"})}, Context(remaining_ms=0)
+    )
+    assert json.loads(http_response["body"]) == {
+        "statusCode": 202,
+        "body": {"JobId": "job", "JobStatus": "IN_PROGRESS"},
+    }
+
+    # Stops on the API Gateway budget, however long the Lambda may run
+    monkeypatch.setattr(lambda_module, "POLL_TIME_BUDGET", 0)
+    http_response = lambda_module.lambda_handler(
+        {"body": json.dumps({"JobId": "job"})}, Context(remaining_ms=900000)
+    )
+    assert json.loads(http_response["body"])["statusCode"] == 202
+
+
+def test_results_follow_next_token(lambda_module, monkeypatch):
+    pages = {
+        None: detected_lines(["first"], next_token="page-2"),
+        "page-2": detected_lines(["second"]),
+    }
+    monkeypatch.setattr(
+        lambda_module.textract_client,
+        "get_document_text_detection",
+        lambda JobId, NextToken=None: pages[NextToken],
+    )
+
+    http_response = lambda_module.lambda_handler(
+        {"body": json.dumps({"JobId": "job", "projection": {"fields": ["Text"]}})},
+        Context(),
+    )
+
+    body = json.loads(http_response["body"])["body"]
+    assert body["columns"] == {"Text": ["first", "second"]}
+
+
+def test_client_polls_until_timeout(gateway, lambda_module, monkeypatch):
+    monkeypatch.setattr(
+        lambda_module.textract_client,
+        "get_document_text_detection",
+        lambda JobId, NextToken=None: {"JobStatus": "IN_PROGRESS"},
+    )
+    monkeypatch.setattr(lambda_module, "POLL_TIME_BUDGET", 0)
+    monkeypatch.setattr(textract, "TEXTRACT_POLL_TIMEOUT", 0.05)
+
+    with pytest.raises(TimeoutError):
+        textract.textract_document("https://api/textract", DOCUMENT, multi_page=True)
+    assert gateway.calls[0] == "binary"
+    assert set(gateway.calls[1:]) == {"json"}
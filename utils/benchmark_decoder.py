@@ -0,0 +1,152 @@
+"""
+Benchmarks caption decoding on CPU, every path compiled with tf.function:
+- the decoder block as it was before (tf.range positions and a causal mask
+  built and tiled on every call), run on all SEQ_LENGTH - 1 positions,
+- the current block (cached positions and mask) on all positions,
+- BucketedDecoder (only the positions decoded so far, one graph per bucket).
+
+Run it with:
+    python -m utils.benchmark_decoder
+"""
+import os
+
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from utils.cnn_transformer import (
+    EMBED_DIM,
+    FF_DIM,
+    SEQ_LENGTH,
+    VOCAB_SIZE,
+    BucketedDecoder,
+    TransformerDecoderBlock,
+)
+
+# Number of image patches produced by EfficientNetB0 on 299x299 inputs
+NUM_PATCHES = 100
+
+# Number of captions decoded per path
+NUM_RUNS = 20
+
+
+class PreviousDecoderBlock(TransformerDecoderBlock):
+    """
+    The decoder block before masks and positions were cached, for comparison.
+    """
+
+    def call(self, inputs, encoder_outputs, training, mask=None):
+        length = tf.shape(inputs)[-1]
+        positions = tf.range(start=0, limit=length, delta=1)
+        embedded_tokens = self.embedding.token_embeddings(inputs)
+        embedded_tokens = embedded_tokens * self.embedding.embed_scale
+        inputs = embedded_tokens + self.embedding.position_embeddings(positions)
+        causal_mask = self.get_causal_attention_mask(inputs)
+
+        if mask is not None:
+            padding_mask = tf.cast(mask[:, :, tf.newaxis], dtype=tf.int32)
+            combined_mask = tf.cast(mask[:, tf.newaxis, :], dtype=tf.int32)
+            combined_mask = tf.minimum(combined_mask, causal_mask)
+
+        attention_output_1 = self.attention_1(
+            query=inputs,
+            value=inputs,
+            key=inputs,
+            attention_mask=combined_mask,
+            training=training,
+        )
+        out_1 = self.layernorm_1(inputs + attention_output_1)
+
+        attention_output_2 = self.attention_2(
+            query=out_1,
+            value=encoder_outputs,
+            key=encoder_outputs,
+            attention_mask=padding_mask,
+            training=training,
+        )
+        out_2 = self.layernorm_2(out_1 + attention_output_2)
+
+        ffn_out = self.ffn_layer_1(out_2)
+        ffn_out = self.dropout_1(ffn_out, training=training)
+        ffn_out = self.ffn_layer_2(ffn_out)
+
+        ffn_out = self.layernorm_3(ffn_out + out_2, training=training)
+        ffn_out = self.dropout_2(ffn_out, training=training)
+        preds = self.out(ffn_out)
+        return preds
+
+    def get_causal_attention_mask(self, inputs):
+        input_shape = tf.shape(inputs)
+        batch_size, sequence_length = input_shape[0], input_shape[1]
+        i = tf.range(sequence_length)[:, tf.newaxis]
+        j = tf.range(sequence_length)
+        mask = tf.cast(i >= j, dtype="int32")
+        mask = tf.reshape(mask, (1, input_shape[1], input_shape[1]))
+        mult = tf.concat(
+            [
+                tf.expand_dims(batch_size, -1),
+                tf.constant([1, 1], dtype=tf.int32),
+            ],
+            axis=0,
+        )
+        return tf.tile(mask, mult)
+
+
+def full_length_step(decoder):
+    @tf.function
+    def step(tokens, encoded_img):
+        mask = tf.math.not_equal(tokens, 0)
+        return decoder(tokens, encoded_img, training=False, mask=mask)
+
+    return lambda tokens, encoded_img, length: step(tokens, encoded_img)
+
+
+def decode(step, encoded_img):
+    """
+    Greedily decodes SEQ_LENGTH - 1 tokens with random token ids, so every
+    step runs regardless of what an untrained decoder predicts.
+    """
+    tokens = np.zeros((1, SEQ_LENGTH - 1), dtype=np.int64)
+    tokens[0, 0] = 2
+    for i in range(SEQ_LENGTH - 2):
+        predictions = step(tokens, encoded_img, length=i + 1)
+        np.argmax(predictions[0, i, :])
+        tokens[0, i + 1] = np.random.randint(2, VOCAB_SIZE)
+
+
+def benchmark(name, step, encoded_img):
+    # The first caption builds the layers and traces the graphs
+    decode(step, encoded_img)
+
+    start = time.perf_counter()
+    for _ in range(NUM_RUNS):
+        decode(step, encoded_img)
+    elapsed = (time.perf_counter() - start) / NUM_RUNS
+    print(f"{name}: {elapsed * 1000:.1f} ms per caption")
+    return elapsed
+
+
+if __name__ == "__main__":
+    encoded_img = tf.random.normal((1, NUM_PATCHES, EMBED_DIM))
+    tokens = np.ones((1, SEQ_LENGTH - 1), dtype=np.int64)
+
+    # Both blocks share the same weights, so their outputs can be compared
+    previous = PreviousDecoderBlock(embed_dim=EMBED_DIM, ff_dim=FF_DIM, num_heads=2)
+    decoder = TransformerDecoderBlock(embed_dim=EMBED_DIM, ff_dim=FF_DIM, num_heads=2)
+    for block in (previous, decoder):
+        block(tokens, encoded_img, training=False, mask=tokens != 0)
+    decoder.set_weights(previous.get_weights())
+    difference = np.abs(
+        previous(tokens, encoded_img, training=False, mask=tokens != 0)
+        - decoder(tokens, encoded_img, training=False, mask=tokens != 0)
+    ).max()
+    print(f"Largest output difference: {difference:.2e}")
+
+    baseline = benchmark("Previous block, full length", full_length_step(previous), encoded_img)
+    cached = benchmark("Cached masks, full length", full_length_step(decoder), encoded_img)
+    bucketed = benchmark("Cached masks, bucketed", BucketedDecoder(decoder), encoded_img)
+    print(f"Speed-up of cached masks: {baseline / cached:.2f}x")
+    print(f"Speed-up of cached masks and buckets: {baseline / bucketed:.2f}x")
@@ -2,7 +2,10 @@ import os
 
 os.environ["KERAS_BACKEND"] = "tensorflow"
 
-import re
+import string
+import sys
+from collections import Counter
+
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -30,6 +33,9 @@ SEQ_LENGTH = 25
 # Vocabulary size
 VOCAB_SIZE = 10000
 
+# Sequence lengths the decoder graphs are specialized for during inference
+DECODE_BUCKETS = (8, 16, SEQ_LENGTH - 1)
+
 # Data augmentation for image data
 image_augmentation = keras.Sequential(
     [
@@ -96,9 +102,12 @@ class PositionalEmbedding(layers.Layer):
         self.embed_dim = embed_dim
         self.embed_scale = tf.math.sqrt(tf.cast(embed_dim, tf.float32))
 
+        # Positions of the longest sequence, sliced to the input length
+        self.positions = tf.range(start=0, limit=sequence_length, delta=1)
+
     def call(self, inputs):
         length = tf.shape(inputs)[-1]
-        positions = tf.range(start=0, limit=length, delta=1)
+        positions = self.positions[:length]
         embedded_tokens = self.token_embeddings(inputs)
         embedded_tokens = embedded_tokens * self.embed_scale
         embedded_positions = self.position_embeddings(positions)
@@ -138,14 +147,22 @@ class TransformerDecoderBlock(layers.Layer):
         self.dropout_2 = layers.Dropout(0.5)
         self.supports_masking = True
 
+        # Causal mask of the longest sequence, (1, L, L) so it broadcasts
+        # over the batch instead of being tiled on every call
+        causal_mask = np.tril(np.ones((SEQ_LENGTH, SEQ_LENGTH), dtype="int32"))
+        self.causal_mask = tf.constant(causal_mask[np.newaxis])
+
     def call(self, inputs, encoder_outputs, training, mask=None):
         inputs = self.embedding(inputs)
         causal_mask = self.get_causal_attention_mask(inputs)
 
         if mask is not None:
-            padding_mask = tf.cast(mask[:, :, tf.newaxis], dtype=tf.int32)
-            combined_mask = tf.cast(mask[:, tf.newaxis, :], dtype=tf.int32)
-            combined_mask = tf.minimum(combined_mask, causal_mask)
+            mask = tf.cast(mask, dtype=tf.int32)
+            padding_mask = mask[:, :, tf.newaxis]
+            combined_mask = tf.minimum(mask[:, tf.newaxis, :], causal_mask)
+        else:
+            padding_mask = None
+            combined_mask = causal_mask
 
         attention_output_1 = self.attention_1(
             query=inputs,
@@ -175,20 +192,38 @@ class TransformerDecoderBlock(layers.Layer):
         return preds
 
     def get_causal_attention_mask(self, inputs):
-        input_shape = tf.shape(inputs)
-        batch_size, sequence_length = input_shape[0], input_shape[1]
-        i = tf.range(sequence_length)[:, tf.newaxis]
-        j = tf.range(sequence_length)
-        mask = tf.cast(i >= j, dtype="int32")
-        mask = tf.reshape(mask, (1, input_shape[1], input_shape[1]))
-        mult = tf.concat(
-            [
-                tf.expand_dims(batch_size, -1),
-                tf.constant([1, 1], dtype=tf.int32),
-            ],
-            axis=0,
-        )
-        return tf.tile(mask, mult)
+        sequence_length = tf.shape(inputs)[1]
+        return self.causal_mask[:, :sequence_length, :sequence_length]
+
+
+class BucketedDecoder:
+    """
+    Runs a decoder for inference on the first tokens of a caption only, padded
+    to the next length in DECODE_BUCKETS, with one compiled graph per bucket.
+    """
+
+    def __init__(self, decoder, buckets=DECODE_BUCKETS):
+        self.decoder = decoder
+        self.buckets = buckets
+        self._steps = {}
+
+    def _step(self, bucket):
+        if bucket not in self._steps:
+
+            def step(tokens, encoded_img):
+                mask = tf.math.not_equal(tokens, 0)
+                return self.decoder(tokens, encoded_img, training=False, mask=mask)
+
+            self._steps[bucket] = tf.function(step)
+        return self._steps[bucket]
+
+    def __call__(self, tokens, encoded_img, length):
+        """
+        Returns the decoder predictions for the first `length` positions.
+        Because of the causal mask, they do not depend on later tokens.
+        """
+        bucket = next(b for b in self.buckets if b >= length)
+        return self._step(bucket)(tokens[:, :bucket], encoded_img)
 
 
 class ImageCaptioningModel(keras.Model):
@@ -324,20 +359,230 @@ strip_chars = "!\"#$%&'()*+,-./:;<=>?@[\]^_`{|}~"
 strip_chars = strip_chars.replace("<", "")
 strip_chars = strip_chars.replace(">", "")
 
+# Same standardization as custom_standardization: tf.strings.lower only
+# lowercases ASCII, so the Python side does too
+strip_table = str.maketrans(
+    string.ascii_uppercase, string.ascii_lowercase, strip_chars
+)
+
+# strip_chars as a tensor, one character per element
+strip_tensor = tf.constant(list(strip_chars))
+
+# Vocabulary artifact saved next to the checkpoint, one token per line
+# (without the padding and OOV tokens, which TextVectorization adds itself)
+VOCAB_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "models",
+    "cnn_transformer",
+    "vocabulary.txt",
+)
+
 
 def custom_standardization(input_string):
+    # strip_chars are ASCII, so they can be dropped byte by byte without
+    # touching multi-byte characters and without a regex
     lowercase = tf.strings.lower(input_string)
-    return tf.strings.regex_replace(lowercase, "[%s]" % re.escape(strip_chars), "")
-
+    chars = tf.strings.bytes_split(lowercase)
+    keep = tf.ragged.map_flat_values(
+        lambda c: tf.reduce_all(tf.not_equal(c[:, tf.newaxis], strip_tensor), axis=-1),
+        chars,
+    )
+    return tf.strings.reduce_join(tf.ragged.boolean_mask(chars, keep), axis=-1)
+
+
+def standardize(caption: str) -> str:
+    return caption.translate(strip_table)
+
+
+def split_tokens(caption: str):
+    # TextVectorization splits on ASCII whitespace only
+    return [token.decode("utf-8") for token in caption.encode("utf-8").split()]
+
+
+def read_captions(path: str):
+    """
+    Streams the captions of a Flickr8k style token file ("image.jpg#0<TAB>caption"
+    per line, or one caption per line), wrapped in <start>/<end> tokens.
+    """
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            caption = line.rstrip("\n").split("\t")[-1].strip()
+            if caption:
+                yield "<start> " + caption + " <end>"
+
+
+def build_vocabulary(captions, path: str = VOCAB_PATH, max_tokens: int = VOCAB_SIZE):
+    """
+    Builds the vocabulary in a single pass over the captions and saves it.
+
+    Args:
+    captions: An iterable of captions, e.g. read_captions(token_file).
+    path (str): Where to save the vocabulary.
+    max_tokens (int): The vocabulary size, including the padding and OOV tokens.
+
+    Returns:
+    list: The saved tokens, most frequent first.
+    """
+    counts = Counter()
+    for caption in captions:
+        counts.update(split_tokens(standardize(caption)))
+
+    # Same order as TextVectorization.adapt: by count, ties by token, both
+    # descending, so the ids match checkpoints trained with adapted vocabularies
+    ranked = sorted(counts.items(), key=lambda kv: (kv[1], kv[0]), reverse=True)
+    tokens = [token for token, _ in ranked[: max_tokens - 2]]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("\n".join(tokens) + "\n")
+    return tokens
+
+
+class Vocabulary:
+    """
+    The id <-> token tables shared by training (through `vectorization`) and
+    caption decoding, loaded from the saved vocabulary instead of re-adapted.
+    """
+
+    def __init__(self, path: str = VOCAB_PATH):
+        if not os.path.exists(path):
+            raise FileNotFoundError(
+                f"No caption vocabulary at {path}. Build it from the caption file "
+                "the checkpoint was trained on: "
+                "python -m utils.cnn_transformer Flickr8k.token.txt"
+            )
+        with open(path, encoding="utf-8") as f:
+            tokens = [line.rstrip("\n") for line in f if line.rstrip("\n")]
+
+        # Same ids as TextVectorization: 0 is padding, 1 is out of vocabulary
+        self.index_lookup = ["", "[UNK]"] + tokens
+        self.token_index = {token: i for i, token in enumerate(self.index_lookup)}
+        self.vectorization = TextVectorization(
+            max_tokens=VOCAB_SIZE,
+            output_mode="int",
+            output_sequence_length=SEQ_LENGTH,
+            standardize=custom_standardization,
+            vocabulary=tokens,
+        )
 
-vectorization = TextVectorization(
-    max_tokens=VOCAB_SIZE,
-    output_mode="int",
-    output_sequence_length=SEQ_LENGTH,
-    standardize=custom_standardization,
+    def encode(self, caption: str, length: int = SEQ_LENGTH) -> np.ndarray:
+        """
+        Tokenizes a caption in Python, matching `vectorization` without a
+        round trip through TensorFlow.
+        """
+        ids = [self.token_index.get(t, 1) for t in split_tokens(standardize(caption))]
+        ids = ids[:length] + [0] * max(0, length - len(ids))
+        return np.array([ids], dtype=np.int64)
+
+
+_vocabulary = None
+
+
+def get_vocabulary(path: str = VOCAB_PATH) -> Vocabulary:
+    """
+    Returns the saved vocabulary, loaded once per process.
+    """
+    global _vocabulary
+    if _vocabulary is None:
+        _vocabulary = Vocabulary(path)
+    return _vocabulary
+
+
+def get_bucketed_decoder(decoder) -> BucketedDecoder:
+    """
+    Returns the BucketedDecoder of a decoder, so that its graphs are compiled
+    once per decoder rather than once per caption. It is kept on the decoder
+    itself and goes away with it.
+    """
+    bucketed = getattr(decoder, "_bucketed_decoder", None)
+    if bucketed is None:
+        bucketed = BucketedDecoder(decoder)
+        decoder._bucketed_decoder = bucketed
+    return bucketed
+
+
+# Checkpoint of the trained captioning model
+CHECKPOINT_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "..",
+    "models",
+    "cnn_transformer",
+    "tf_keras_image_captioning_cnn+transformer_flicker8k",
 )
 
 
+def load_caption_model(checkpoint_path: str = CHECKPOINT_PATH) -> ImageCaptioningModel:
+    """
+    Builds the captioning model and restores its trained weights.
+    """
+    cnn_model = get_cnn_model()
+    encoder = TransformerEncoderBlock(embed_dim=EMBED_DIM, dense_dim=FF_DIM, num_heads=1)
+    decoder = TransformerDecoderBlock(embed_dim=EMBED_DIM, ff_dim=FF_DIM, num_heads=2)
+    caption_model = ImageCaptioningModel(
+        cnn_model=cnn_model,
+        encoder=encoder,
+        decoder=decoder,
+        image_aug=image_augmentation,
+    )
+
+    # Create the variables before restoring them
+    img = caption_model.encoder(
+        caption_model.cnn_model(np.zeros((1, *IMAGE_SIZE, 3), dtype="float32")),
+        training=False,
+    )
+    tokens = np.ones((1, SEQ_LENGTH - 1), dtype=np.int64)
+    caption_model.decoder(tokens, img, training=False, mask=tokens != 0)
+
+    tf.train.Checkpoint(caption_model).restore(checkpoint_path).expect_partial()
+    return caption_model
+
+
+class Captioner:
+    """
+    Captions a batch of images at once: one CNN and encoder pass for the batch,
+    then greedy decoding of every caption in the same decoder calls.
+    """
+
+    def __init__(self, caption_model: ImageCaptioningModel):
+        self.caption_model = caption_model
+        self.vocabulary = get_vocabulary()
+        self.decoder = get_bucketed_decoder(caption_model.decoder)
+
+    def caption(self, images) -> list:
+        img = np.stack(
+            [
+                np.asarray(image.convert("RGB").resize(IMAGE_SIZE), dtype="float32")
+                for image in images
+            ]
+        )
+        img = self.caption_model.cnn_model(img)
+        encoded_img = self.caption_model.encoder(img, training=False)
+
+        index_lookup = self.vocabulary.index_lookup
+        end_index = self.vocabulary.token_index.get("<end>")
+        tokens = np.zeros((len(images), SEQ_LENGTH - 1), dtype=np.int64)
+        tokens[:, 0] = self.vocabulary.token_index.get("<start>", 1)
+        words = [[] for _ in images]
+        finished = np.zeros(len(images), dtype=bool)
+        for i in range(SEQ_LENGTH - 1):
+            predictions = self.decoder(tokens, encoded_img, length=i + 1)
+            sampled = np.argmax(predictions[:, i, :], axis=-1)
+            finished |= sampled == end_index
+            for n in np.flatnonzero(~finished):
+                words[n].append(index_lookup[sampled[n]])
+            if finished.all() or i + 1 == SEQ_LENGTH - 1:
+                break
+            tokens[:, i + 1] = sampled
+
+        return [" ".join(caption) for caption in words]
+
+    def __call__(self, images):
+        # Same calling convention as the pipelines: a single image gives a
+        # single caption, a list gives a list
+        if isinstance(images, list):
+            return self.caption(images)
+        return self.caption([images])[0]
+
+
 def generate_caption(caption_model: None):
     # Select a random image from the validation dataset
     # sample_img = np.random.choice(valid_images)
@@ -359,15 +604,13 @@ def generate_caption(caption_model: None):
 
     # Generate the caption using the Transformer decoder
     decoded_caption = "<start> "
-    vocab = vectorization.get_vocabulary()
-    index_lookup = dict(zip(range(len(vocab)), vocab))
+    vocabulary = get_vocabulary()
+    index_lookup = vocabulary.index_lookup
+    decoder = get_bucketed_decoder(caption_model.decoder)
     max_decoded_sentence_length = SEQ_LENGTH - 1
     for i in range(max_decoded_sentence_length):
-        tokenized_caption = vectorization([decoded_caption])[:, :-1]
-        mask = tf.math.not_equal(tokenized_caption, 0)
-        predictions = caption_model.decoder(
-            tokenized_caption, encoded_img, training=False, mask=mask
-        )
+        tokenized_caption = vocabulary.encode(decoded_caption)[:, :-1]
+        predictions = decoder(tokenized_caption, encoded_img, length=i + 1)
         sampled_token_index = np.argmax(predictions[0, i, :])
         sampled_token = index_lookup[sampled_token_index]
         if sampled_token == "<end>":
@@ -376,4 +619,10 @@ def generate_caption(caption_model: None):
 
     decoded_caption = decoded_caption.replace("<start> ", "")
     decoded_caption = decoded_caption.replace(" <end>", "").strip()
-    print("Predicted Caption: ", decoded_caption)
\ No newline at end of file
+    print("Predicted Caption: ", decoded_caption)
+
+
+if __name__ == "__main__":
+    # Build the vocabulary from a caption file, e.g. Flickr8k.token.txt
+    tokens = build_vocabulary(read_captions(sys.argv[1]))
+    print(f"Saved {len(tokens)} tokens to {VOCAB_PATH}")
@@ -0,0 +1,313 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils import registry
+
+# Set up logging.
+logger = logging.getLogger(__name__)
+
+# Documents older than this many seconds are evicted (default: one week)
+MAX_DOCUMENT_AGE = float(os.environ.get("CORPUS_MAX_DOCUMENT_AGE", 7 * 24 * 3600))
+
+# Oldest documents are evicted once a user's corpus exceeds this many chunks
+MAX_CHUNKS_PER_USER = int(os.environ.get("CORPUS_MAX_CHUNKS_PER_USER", 200000))
+
+# Oldest documents of any user are evicted once all corpora together exceed
+# this many chunks, however many (anonymous) users there are
+MAX_CHUNKS_TOTAL = int(os.environ.get("CORPUS_MAX_CHUNKS_TOTAL", 1000000))
+
+# Seconds between two eviction passes
+EVICTION_INTERVAL = 60.0
+
+
+def document_id_for(content: bytes) -> str:
+    """
+    Returns a stable id for a document, so that re-uploads are not re-indexed.
+    """
+    return hashlib.sha1(content).hexdigest()
+
+
+def collection_name_for(user_id: str) -> str:
+    # Chroma collection names are limited to 3-63 [a-zA-Z0-9_-] characters
+    return "corpus-" + hashlib.sha1(user_id.encode("utf-8")).hexdigest()[:16]
+
+
+def split_pages(page_texts: List[str]) -> List[Dict[str, Any]]:
+    """
+    Splits the pages of a document into chunks, keeping the page number and
+    the character offsets of each chunk within its page. The token splitter
+    may normalize the text (e.g. lowercase it); chunks that cannot be found
+    verbatim get the offsets of the character chunk they were split from.
+
+    Args:
+    page_texts (List[str]): The text of each page, in page order.
+
+    Returns:
+    List[Dict[str, Any]]: The chunks with their "text", "page", "start" and "end".
+    """
+    character_splitter = registry.get("character_splitter")
+    token_splitter = registry.get("token_splitter")
+
+    chunks = []
+    for page, text in enumerate(page_texts, start=1):
+        if not text:
+            continue
+        cursor = 0
+        for character_chunk in character_splitter.split_text(text):
+            start = text.find(character_chunk, cursor)
+            if start < 0:
+                start = cursor
+            end = start + len(character_chunk)
+            cursor = end
+            token_cursor = 0
+            for token_chunk in token_splitter.split_text(character_chunk):
+                token_start = character_chunk.find(token_chunk, token_cursor)
+                if token_start < 0:
+                    chunk_start, chunk_end = start, end
+                else:
+                    token_cursor = token_start + len(token_chunk)
+                    chunk_start, chunk_end = start + token_start, start + token_cursor
+                chunks.append(
+                    {
+                        "text": token_chunk,
+                        "page": page,
+                        "start": chunk_start,
+                        "end": chunk_end,
+                    }
+                )
+    return chunks
+
+
+class CorpusManager:
+    """
+    Indexes many documents per user in one Chroma collection per user, with
+    per-chunk metadata (document id and name, page, offsets, upload time) that
+    queries can filter on before vector scoring. Old documents are evicted in
+    the background by age, by corpus size and by the size of all corpora.
+    """
+
+    def __init__(
+        self,
+        max_document_age: float = MAX_DOCUMENT_AGE,
+        max_chunks_per_user: int = MAX_CHUNKS_PER_USER,
+        max_chunks_total: int = MAX_CHUNKS_TOTAL,
+        eviction_interval: float = EVICTION_INTERVAL,
+    ):
+        import chromadb
+
+        self.client = chromadb.Client()
+        self.max_document_age = max_document_age
+        self.max_chunks_per_user = max_chunks_per_user
+        self.max_chunks_total = max_chunks_total
+
+        # user_id -> document_id -> {"name", "uploaded_at", "chunks"}
+        self.documents: Dict[str, Dict[str, Dict[str, Any]]] = {}
+        self._lock = threading.RLock()
+
+        # (user_id, document_id) -> Event set once that document is indexed
+        self._indexing: Dict[Tuple[str, str], threading.Event] = {}
+
+        self._eviction_interval = eviction_interval
+        threading.Thread(
+            target=self._evict_forever, name="corpus-eviction", daemon=True
+        ).start()
+
+    def _collection(self, user_id: str):
+        return self.client.get_or_create_collection(
+            collection_name_for(user_id),
+            embedding_function=registry.get("embedding_function"),
+        )
+
+    def has_document(self, user_id: str, document_id: str) -> bool:
+        with self._lock:
+            return document_id in self.documents.get(user_id, {})
+
+    def list_documents(self, user_id: str) -> Dict[str, Dict[str, Any]]:
+        with self._lock:
+            return dict(self.documents.get(user_id, {}))
+
+    def add_document(
+        self,
+        user_id: str,
+        document_id: str,
+        name: str,
+        page_texts: List[str],
+    ) -> int:
+        """
+        Chunks and indexes a document unless it is already in the corpus.
+
+        Args:
+        user_id (str): The owner of the corpus.
+        document_id (str): The id of the document, see document_id_for.
+        name (str): The file name shown to the user.
+        page_texts (List[str]): The text of each page, in page order.
+
+        Returns:
+        int: The number of chunks of the document.
+        """
+        key = (user_id, document_id)
+        while True:
+            # Reserve the document id, so that a concurrent upload of the same
+            # file waits for this one instead of adding the same chunk ids
+            with self._lock:
+                if self.has_document(user_id, document_id):
+                    return self.documents[user_id][document_id]["chunks"]
+                indexing = self._indexing.get(key)
+                if indexing is None:
+                    self._indexing[key] = threading.Event()
+                    break
+            # Retry if the other upload failed
+            indexing.wait()
+
+        try:
+            chunks = split_pages(page_texts)
+            uploaded_at = time.time()
+            if chunks:
+                self._collection(user_id).add(
+                    ids=[f"{document_id}:{i}" for i in range(len(chunks))],
+                    documents=[chunk["text"] for chunk in chunks],
+                    metadatas=[
+                        {
+                            "document_id": document_id,
+                            "document_name": name,
+                            "page": chunk["page"],
+                            "start": chunk["start"],
+                            "end": chunk["end"],
+                            "uploaded_at": uploaded_at,
+                        }
+                        for chunk in chunks
+                    ],
+                )
+
+            with self._lock:
+                self.documents.setdefault(user_id, {})[document_id] = {
+                    "name": name,
+                    "uploaded_at": uploaded_at,
+                    "chunks": len(chunks),
+                }
+            return len(chunks)
+        finally:
+            with self._lock:
+                self._indexing.pop(key).set()
+
+    def query(
+        self,
+        user_id: str,
+        query: str,
+        n_results: int = 5,
+        document_ids: Optional[List[str]] = None,
+        where: Optional[Dict[str, Any]] = None,
+    ) -> Dict[str, Any]:
+        """
+        Retrieves the chunks closest to the query across the user's corpus.
+
+        Args:
+        user_id (str): The owner of the corpus.
+        query (str): The question to retrieve chunks for.
+        n_results (int): The number of chunks to return.
+        document_ids (Optional[List[str]]): Restricts the search to these documents.
+        where (Optional[Dict[str, Any]]): Any other Chroma metadata filter, e.g.
+        {"page": {"$lte": 3}}, applied before vector scoring.
+
+        Returns:
+        Dict[str, Any]: The Chroma query results (ids, documents, metadatas, distances).
+        """
+        documents = self.list_documents(user_id)
+        if document_ids is not None:
+            documents = {k: v for k, v in documents.items() if k in document_ids}
+
+        # Never ask for more chunks than the filter can return
+        available = sum(document["chunks"] for document in documents.values())
+        if available == 0:
+            return {
+                "ids": [[]],
+                "documents": [[]],
+                "metadatas": [[]],
+                "distances": [[]],
+            }
+
+        filters = []
+        if document_ids is not None:
+            id_filters = [{"document_id": document_id} for document_id in documents]
+            if len(id_filters) == 1:
+                filters.append(id_filters[0])
+            else:
+                filters.append({"$or": id_filters})
+        if where:
+            filters.append(where)
+
+        kwargs: Dict[str, Any] = {}
+        if len(filters) == 1:
+            kwargs["where"] = filters[0]
+        elif filters:
+            kwargs["where"] = {"$and": filters}
+
+        return self._collection(user_id).query(
+            query_texts=[query], n_results=min(n_results, available), **kwargs
+        )
+
+    def remove_document(self, user_id: str, document_id: str) -> None:
+        with self._lock:
+            documents = self.documents.get(user_id, {})
+            if documents.pop(document_id, None) is None:
+                return
+
+            # Drop the whole collection with the user's last document, unless
+            # another document of the user is being indexed
+            indexing = any(key[0] == user_id for key in self._indexing)
+            if not documents and not indexing:
+                del self.documents[user_id]
+                try:
+                    self.client.delete_collection(collection_name_for(user_id))
+                except ValueError:
+                    # Never created, the user's documents had no text
+                    pass
+                return
+
+        self._collection(user_id).delete(where={"document_id": document_id})
+
+    def evict(self) -> None:
+        """
+        Removes documents older than max_document_age, then the oldest documents
+        of every user whose corpus holds more than max_chunks_per_user chunks,
+        then the oldest documents overall while all corpora together hold more
+        than max_chunks_total chunks.
+        """
+        now = time.time()
+        expired = []
+        kept = []
+        with self._lock:
+            for user_id, documents in self.documents.items():
+                by_age = sorted(documents.items(), key=lambda kv: kv[1]["uploaded_at"])
+                total = sum(document["chunks"] for _, document in by_age)
+                for document_id, document in by_age:
+                    too_old = now - document["uploaded_at"] > self.max_document_age
+                    if too_old or total > self.max_chunks_per_user:
+                        expired.append((user_id, document_id))
+                        total -= document["chunks"]
+                    else:
+                        kept.append(
+                            (document["uploaded_at"], user_id, document_id, document["chunks"])
+                        )
+
+            total = sum(chunks for _, _, _, chunks in kept)
+            for _, user_id, document_id, chunks in sorted(kept):
+                if total <= self.max_chunks_total:
+                    break
+                expired.append((user_id, document_id))
+                total -= chunks
+
+        for user_id, document_id in expired:
+            self.remove_document(user_id, document_id)
+
+    def _evict_forever(self):
+        while True:
+            time.sleep(self._eviction_interval)
+            try:
+                self.evict()
+            except Exception as e:
+                logger.warning("Corpus eviction failed: %s", e)
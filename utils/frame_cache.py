@@ -0,0 +1,115 @@
+import threading
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+import numpy as np
+from PIL import Image
+
+# Side of the downscaled grayscale copy used for hashing (64-bit hash)
+HASH_SIZE = 8
+
+# Largest Hamming distance at which two frames count as the same shot
+HAMMING_THRESHOLD = 6
+
+# Number of recently analysed frames kept in the cache
+MAX_FRAMES = 128
+
+
+def dhash(image: Image.Image, hash_size: int = HASH_SIZE) -> int:
+    """
+    Computes the difference hash (dHash) of an image.
+
+    Args:
+    image (Image.Image): The image to hash.
+    hash_size (int): The side of the hash grid, giving hash_size**2 bits.
+
+    Returns:
+    int: The hash, one bit per horizontal gradient of the downscaled image.
+    """
+    small = image.convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def hamming_distances(hashes: np.ndarray, frame_hash: int) -> np.ndarray:
+    """
+    Computes the Hamming distance between one hash and an array of hashes.
+
+    Args:
+    hashes (np.ndarray): The uint64 hashes to compare against.
+    frame_hash (int): The hash of the new frame.
+
+    Returns:
+    np.ndarray: The number of differing bits for each hash.
+    """
+    xor = np.bitwise_xor(hashes, np.uint64(frame_hash))
+    bits = np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1)
+    return bits.sum(axis=1)
+
+
+class FrameCache:
+    """
+    Keeps the Gemini and YOLO results of recently analysed camera frames,
+    keyed by perceptual hash, so that a retake of the same shot reuses them.
+    A 64-bit dHash cannot tell apart documents that differ only in their text,
+    so it must be scoped to one session and never used for OCR results.
+    """
+
+    def __init__(self, max_frames: int = MAX_FRAMES, threshold: int = HAMMING_THRESHOLD):
+        self.max_frames = max_frames
+        self.threshold = threshold
+        self._hashes = np.empty(0, dtype=np.uint64)
+        self._results: List[Dict[Hashable, Any]] = []
+        self._lock = threading.Lock()
+
+    def results_for(self, frame_hash: int) -> Dict[Hashable, Any]:
+        """
+        Returns the results of the closest cached frame within the threshold,
+        or a new empty entry for this frame.
+        """
+        with self._lock:
+            if len(self._hashes):
+                distances = hamming_distances(self._hashes, frame_hash)
+                nearest = int(np.argmin(distances))
+                if distances[nearest] <= self.threshold:
+                    return self._results[nearest]
+
+            # Drop the oldest frame once the cache is full
+            if len(self._results) >= self.max_frames:
+                self._hashes = self._hashes[1:]
+                self._results = self._results[1:]
+
+            results: Dict[Hashable, Any] = {}
+            self._hashes = np.append(self._hashes, np.uint64(frame_hash))
+            self._results.append(results)
+            return results
+
+    def get_or_compute(
+        self,
+        frame_hash: int,
+        key: Hashable,
+        compute: Callable[[], Any],
+        should_cache: Optional[Callable[[Any], bool]] = None,
+    ) -> Any:
+        """
+        Returns the cached result `key` of a near-duplicate frame, calling
+        `compute` only when there is none yet.
+
+        Args:
+        frame_hash (int): The dHash of the frame.
+        key (Hashable): The kind of result, e.g. "yolo" or ("gemini", prompt).
+        compute (Callable[[], Any]): Produces the result on a cache miss.
+        should_cache (Optional[Callable[[Any], bool]]): Decides whether a fresh
+        result is kept, e.g. to skip API error responses. Defaults to always.
+
+        Returns:
+        Any: The cached or freshly computed result.
+        """
+        results = self.results_for(frame_hash)
+        if key in results:
+            return results[key]
+
+        result = compute()
+        if should_cache is None or should_cache(result):
+            results[key] = result
+        return result
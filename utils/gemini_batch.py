@@ -0,0 +1,294 @@
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+import requests
+
+GEMINI_URL = "https://generativelanguage.googleapis.com/v1beta/models/gemini-pro-vision:generateContent"
+
+# Limits of a single generateContent request
+MAX_IMAGES_PER_REQUEST = 16
+MAX_PAYLOAD_BYTES = 16 * 1024 * 1024
+MAX_INPUT_TOKENS = 12288
+
+# Gemini bills a fixed number of tokens per image, text is roughly 4 chars/token
+TOKENS_PER_IMAGE = 258
+CHARS_PER_TOKEN = 4
+
+# How long the batcher waits for more requests before sending a batch
+COALESCE_WINDOW = 0.05
+
+# Marker the model is asked to put in front of each answer
+ANSWER_MARKER = "### Image {}"
+
+# An item is a base64 encoded JPEG and the prompt to ask about it
+Item = Tuple[str, str]
+
+# HTTP statuses that fail a whole batch rather than one of its images
+BATCH_FAILURE_STATUSES = {429, 500, 502, 503, 504}
+
+
+def estimate_tokens(item: Item) -> int:
+    """
+    Estimates the number of input tokens an image and its prompt use.
+    """
+    return TOKENS_PER_IMAGE + len(item[1]) // CHARS_PER_TOKEN + 8
+
+
+def pack_batches(
+    items: List[Item],
+    max_images: int = MAX_IMAGES_PER_REQUEST,
+    max_payload_bytes: int = MAX_PAYLOAD_BYTES,
+    max_tokens: int = MAX_INPUT_TOKENS,
+) -> List[List[int]]:
+    """
+    Groups items, in order, into batches that stay within the request limits.
+
+    Args:
+    items (List[Item]): The (image_base64, prompt) pairs to send.
+    max_images (int): The maximum number of images per request.
+    max_payload_bytes (int): The maximum size of the images and prompts.
+    max_tokens (int): The maximum estimated number of input tokens.
+
+    Returns:
+    List[List[int]]: The indices of the items in each batch.
+    """
+    batches: List[List[int]] = []
+    current: List[int] = []
+    payload_bytes, tokens = 0, 0
+
+    for i, item in enumerate(items):
+        item_bytes = len(item[0]) + len(item[1])
+        item_tokens = estimate_tokens(item)
+        if current and (
+            len(current) >= max_images
+            or payload_bytes + item_bytes > max_payload_bytes
+            or tokens + item_tokens > max_tokens
+        ):
+            batches.append(current)
+            current, payload_bytes, tokens = [], 0, 0
+        current.append(i)
+        payload_bytes += item_bytes
+        tokens += item_tokens
+
+    if current:
+        batches.append(current)
+    return batches
+
+
+def build_batch_request(items: List[Item]) -> Dict[str, Any]:
+    """
+    Builds one generateContent payload for several images and their prompts.
+    A single item gives the same payload as call_gemini_api.
+    """
+    if len(items) == 1:
+        image_base64, prompt = items[0]
+        parts = [
+            {"text": prompt},
+            {"inline_data": {"mime_type": "image/jpeg", "data": image_base64}},
+        ]
+        return {"contents": [{"parts": parts}]}
+
+    parts = [
+        {
+            "text": (
+                f"You are given {len(items)} images, each followed by a question. "
+                "Answer every question in order. Start each answer on its own line "
+                f"with '{ANSWER_MARKER.format('<n>')}' where <n> is the image number."
+            )
+        }
+    ]
+    for n, (image_base64, prompt) in enumerate(items, start=1):
+        parts.append({"text": f"{ANSWER_MARKER.format(n)}: {prompt}"})
+        parts.append({"inline_data": {"mime_type": "image/jpeg", "data": image_base64}})
+    return {"contents": [{"parts": parts}]}
+
+
+def response_text(response: Dict[str, Any]) -> Optional[str]:
+    """
+    Returns the text of the first candidate of a generateContent response.
+    """
+    try:
+        return response["candidates"][0]["content"]["parts"][0]["text"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def is_blocked(response: Dict[str, Any]) -> bool:
+    """
+    Checks whether a generateContent response was blocked by the safety filters.
+    """
+    if response.get("promptFeedback", {}).get("blockReason"):
+        return True
+    return any(
+        candidate.get("finishReason") == "SAFETY"
+        for candidate in response.get("candidates", [])
+    )
+
+
+def wrap_text(text: str, response: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Wraps an answer in the shape of a generateContent response, so that the
+    callers of call_gemini_api can read batched answers the same way. The
+    finishReason and safetyRatings of the batched response are kept.
+    """
+    candidate = dict(response["candidates"][0])
+    candidate["content"] = {"parts": [{"text": text}]}
+    wrapped = {key: value for key, value in response.items() if key != "candidates"}
+    wrapped["candidates"] = [candidate]
+    return wrapped
+
+
+def split_batch_response(response: Dict[str, Any], count: int) -> List[Optional[str]]:
+    """
+    Splits the answer to a batched request back into one answer per image.
+
+    Args:
+    response (Dict[str, Any]): The generateContent response.
+    count (int): The number of images in the request.
+
+    Returns:
+    List[Optional[str]]: The answer for each image, None where it is missing.
+    """
+    text = response_text(response)
+    answers: List[Optional[str]] = [None] * count
+    if text is None:
+        return answers
+
+    pattern = re.compile(r"^\s*#+\s*Image\s+(\d+)\s*:?", re.M)
+    matches = list(pattern.finditer(text))
+    for k, match in enumerate(matches):
+        n = int(match.group(1))
+        end = matches[k + 1].start() if k + 1 < len(matches) else len(text)
+        if 1 <= n <= count and answers[n - 1] is None:
+            answers[n - 1] = text[match.end() : end].strip()
+    return answers
+
+
+def call_gemini_batch(
+    items: List[Item],
+    api_key: str,
+    url: str = GEMINI_URL,
+    post: Callable[..., Any] = requests.post,
+) -> List[Dict[str, Any]]:
+    """
+    Analyses many images with as few generateContent requests as possible.
+
+    Args:
+    items (List[Item]): The (image_base64, prompt) pairs to analyse.
+    api_key (str): API key for accessing the Gemini API.
+    url (str): The generateContent endpoint, e.g. a local stub in tests.
+    post (Callable[..., Any]): The function used to send the request.
+
+    Returns:
+    List[Dict[str, Any]]: One response per item, in the shape returned by
+    call_gemini_api.
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(items)
+
+    for batch in pack_batches(items):
+        batch_items = [items[i] for i in batch]
+        http_response = post(
+            f"{url}?key={api_key}",
+            headers={"Content-Type": "application/json"},
+            json=build_batch_request(batch_items),
+        )
+        response = http_response.json()
+
+        # A single image, or a batch that failed as a whole (quota, server
+        # error), gets the response as is
+        if len(batch) == 1 or http_response.status_code in BATCH_FAILURE_STATUSES:
+            for i in batch:
+                results[i] = response
+            continue
+
+        # A safety block (or any other answer without text) may come from one
+        # image only, so every image is asked again on its own
+        if is_blocked(response) or response_text(response) is None:
+            answers: List[Optional[str]] = [None] * len(batch)
+        else:
+            answers = split_batch_response(response, len(batch))
+
+        # Images whose answer could not be found are asked again on their own
+        for i, answer in zip(batch, answers):
+            if answer is not None:
+                results[i] = wrap_text(answer, response)
+            else:
+                results[i] = call_gemini_batch([items[i]], api_key, url, post)[0]
+
+    return results
+
+
+class GeminiBatcher:
+    """
+    Coalesces Gemini requests that arrive within a short window into batched
+    generateContent calls. Only requests of the same session are batched
+    together, so that one user's image cannot affect another user's answer.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        window: float = COALESCE_WINDOW,
+        url: str = GEMINI_URL,
+        post: Callable[..., Any] = requests.post,
+        max_concurrent_requests: int = 4,
+    ):
+        self.api_key = api_key
+        self.window = window
+        self.url = url
+        self.post = post
+        self._queue: "queue.Queue[Tuple[Hashable, Item, Future]]" = queue.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrent_requests)
+        self._worker = threading.Thread(
+            target=self._run, name="gemini-batcher", daemon=True
+        )
+        self._worker.start()
+
+    def submit(
+        self,
+        image_base64: str,
+        prompt: str = "What is this picture?",
+        session: Hashable = None,
+    ) -> Future:
+        """
+        Queues an image and its prompt, returning a Future of the response.
+        Requests are only batched with others of the same `session`.
+        """
+        future: Future = Future()
+        self._queue.put((session, (image_base64, prompt), future))
+        return future
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(pending) < MAX_IMAGES_PER_REQUEST:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            sessions: Dict[Hashable, List[Tuple[Item, Future]]] = {}
+            for session, item, future in pending:
+                sessions.setdefault(session, []).append((item, future))
+            for session_pending in sessions.values():
+                self._executor.submit(self._send, session_pending)
+
+    def _send(self, pending: List[Tuple[Item, Future]]):
+        try:
+            responses = call_gemini_batch(
+                [item for item, _ in pending], self.api_key, self.url, self.post
+            )
+        except Exception as e:
+            for _, future in pending:
+                future.set_exception(e)
+            return
+        for (_, future), response in zip(pending, responses):
+            future.set_result(response)
@@ -1,26 +1,30 @@
 import base64
 import io
 import json
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List
 
 import pandas as pd
 import requests
 import streamlit as st
 from PIL import Image
-import google.generativeai as palm
-from pypdf import PdfReader
-from langchain.text_splitter import (
-    RecursiveCharacterTextSplitter,
-    SentenceTransformersTokenTextSplitter,
+
+from utils import registry
+from utils.textract import (
+    TEXTRACT_LINE_PROJECTION,
+    decode_columnar_response,
+    extract_line_items,
+    post_request_and_parse_response,
+    textract_document,
 )
-import chromadb
-from chromadb.utils.embedding_functions import SentenceTransformerEmbeddingFunction
 
+# Set up logging.
+logger = logging.getLogger(__name__)
 
 # API Key (You should set this in your environment variables)
 api_key = st.secrets["PALM_API_KEY"]
-palm.configure(api_key=api_key)
 
 
 # Function to convert the image to bytes for download
@@ -44,6 +48,8 @@ def convert_image_to_base64(image):
 
 # Function to make an API call to Palm
 def call_palm(prompt: str) -> str:
+    # google.generativeai is imported and configured on first use
+    palm = registry.get("palm")
     completion = palm.generate_text(
         model="models/text-bison-001",
         prompt=prompt,
@@ -87,62 +93,88 @@ def safely_get_text(response):
     return None
 
 
-def post_request_and_parse_response(
-    url: str, payload: Dict[str, Any]
-) -> Dict[str, Any]:
+# Number of scanned PDF pages sent to Textract at the same time
+OCR_MAX_WORKERS = 8
+
+
+def single_page_pdf(page: Any) -> bytes:
     """
-    Sends a POST request to the specified URL with the given payload,
-    then parses the byte response to a dictionary.
+    Writes one pypdf page as a standalone PDF. pypdf readers are not thread
+    safe, so this runs on the thread that owns the reader.
 
     Args:
-    url (str): The URL to which the POST request is sent.
-    payload (Dict[str, Any]): The payload to send in the POST request.
+    page (Any): The pypdf page to copy.
 
     Returns:
-    Dict[str, Any]: The parsed dictionary from the response.
+    bytes: The content of the single-page PDF.
     """
-    # Set headers for the POST request
-    headers = {"Content-Type": "application/json"}
+    from pypdf import PdfWriter
 
-    # Send the POST request and get the response
-    response = requests.post(url, json=payload, headers=headers)
+    writer = PdfWriter()
+    writer.add_page(page)
+    buffered = io.BytesIO()
+    writer.write(buffered)
+    return buffered.getvalue()
 
-    # Extract the byte data from the response
-    byte_data = response.content
 
-    # Decode the byte data to a string
-    decoded_string = byte_data.decode("utf-8")
+def ocr_pdf_page(url: str, page_pdf: bytes, page_number: int) -> str:
+    """
+    Runs a single PDF page without extractable text through Textract.
 
-    # Convert the JSON string to a dictionary
-    dict_data = json.loads(decoded_string)
+    Args:
+    url (str): The URL of the Textract Lambda.
+    page_pdf (bytes): The page as a single-page PDF (see single_page_pdf).
+    page_number (int): The page number, used in the log on failure.
 
-    return dict_data
+    Returns:
+    str: The recognized lines of the page, separated by newlines, or an
+    empty string if the page could not be analyzed.
+    """
+    try:
+        # Textract reads single-page PDFs directly, so the page is sent as is
+        # rather than rasterized here
+        result_dict = textract_document(url, page_pdf, content_type="application/pdf")
+        df = decode_columnar_response(result_dict)
+    except Exception as e:
+        # One unreadable page should not stop the ingestion of the whole PDF
+        logger.warning("OCR of page %d failed: %s", page_number, e)
+        return ""
+
+    if "Text" not in df:
+        return ""
+    return "\n".join(df["Text"].dropna()).strip()
 
 
-def extract_line_items(input_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+def extract_pdf_texts(
+    reader: Any, url: str, max_workers: int = OCR_MAX_WORKERS
+) -> List[str]:
     """
-    Extracts items with "BlockType": "LINE" from the provided JSON data.
+    Extracts the text of every page of a PDF, falling back to OCR for scanned
+    pages. The OCR requests run concurrently and the results keep page order.
 
     Args:
-    input_data (Dict[str, Any]): The input JSON data as a dictionary.
+    reader (Any): The pypdf PdfReader of the document.
+    url (str): The URL of the Textract Lambda.
+    max_workers (int): The maximum number of concurrent OCR requests.
 
     Returns:
-    List[Dict[str, Any]]: A list of dictionaries with the extracted data.
+    List[str]: The text of each page, in page order (empty pages included).
     """
-    # Initialize an empty list to hold the extracted line items
-    line_items: List[Dict[str, Any]] = []
-
-    # Get the list of items from the 'body' key in the input data
-    body_items = json.loads(input_data.get("body", "[]"))
-
-    # Iterate through each item in the body
-    for item in body_items:
-        # Check if the BlockType of the item is 'LINE'
-        if item.get("BlockType") == "LINE":
-            # Add the item to the line_items list
-            line_items.append(item)
-
-    return line_items
+    pdf_texts = [(p.extract_text() or "").strip() for p in reader.pages]
+    scanned = [i for i, text in enumerate(pdf_texts) if not text]
+
+    if scanned:
+        # Only the network calls run concurrently, the reader is used serially
+        page_pdfs = [single_page_pdf(reader.pages[i]) for i in scanned]
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            ocr_texts = executor.map(
+                lambda args: ocr_pdf_page(url, *args),
+                zip(page_pdfs, [i + 1 for i in scanned]),
+            )
+            for i, text in zip(scanned, ocr_texts):
+                pdf_texts[i] = text
+
+    return pdf_texts
 
 
 def rag(query: str, retrieved_documents: list, api_key: str = api_key) -> str:
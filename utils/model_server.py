@@ -0,0 +1,277 @@
+"""
+A local inference worker that owns the heavy models (YOLO, the sentence
+transformer embedder, the captioning model) once for every Streamlit process
+on the machine.
+
+Start it with a shared secret:
+    MODEL_SERVER_AUTHKEY=<secret> python -m utils.model_server /tmp/model_server.sock
+
+and point the app at it with MODEL_SERVER_SOCKET=/tmp/model_server.sock and
+the same MODEL_SERVER_AUTHKEY.
+Requests from all connections are micro-batched per model within a deadline.
+Images travel through shared memory, only their descriptors go over the socket.
+"""
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from multiprocessing import resource_tracker, shared_memory
+from multiprocessing.connection import Client, Listener
+from typing import Any, Callable, Dict, List
+
+import numpy as np
+from PIL import Image
+
+from utils import registry
+
+# Set up logging.
+logger = logging.getLogger(__name__)
+
+# Maximum number of inputs run through a model at once
+MAX_BATCH_SIZE = 16
+
+# Seconds a request may wait for others to join its batch
+MAX_BATCH_WAIT = 0.01
+
+# Shared secret checked when a client connects. Messages are pickled, so the
+# server never accepts connections without it
+AUTHKEY = os.environ.get("MODEL_SERVER_AUTHKEY", "").encode() or None
+
+# How each model is run on a list of inputs. Pipelines only batch their
+# forward pass when given a batch size, other models batch on their own
+BATCHED_CALLS: Dict[str, Callable[[Any, List[Any]], List[Any]]] = {
+    "yolo": lambda model, inputs: model(inputs, batch_size=len(inputs)),
+}
+
+
+def _require_authkey() -> bytes:
+    if AUTHKEY is None:
+        raise RuntimeError(
+            "Set MODEL_SERVER_AUTHKEY to the same secret for the model server and the app."
+        )
+    return AUTHKEY
+
+
+def _open_shared_memory(name: str) -> shared_memory.SharedMemory:
+    shm = shared_memory.SharedMemory(name=name)
+    # The client owns the segment, keep this process from unlinking it at exit
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class _Request:
+    def __init__(self, items: List[Any]):
+        self.items = items
+        self.result: Any = None
+        self.done = threading.Event()
+
+
+class MicroBatcher:
+    """
+    Collects the requests for one model and runs them together, waiting at
+    most `max_wait` seconds for a batch of `max_batch` inputs to fill up.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_batch: int = MAX_BATCH_SIZE,
+        max_wait: float = MAX_BATCH_WAIT,
+    ):
+        self.name = name
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        threading.Thread(
+            target=self._run, name=f"batcher-{name}", daemon=True
+        ).start()
+
+    def __call__(self, items: List[Any]) -> Any:
+        request = _Request(items)
+        self._queue.put(request)
+        request.done.wait()
+        return request.result
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            count = len(batch[0].items)
+            deadline = time.monotonic() + self.max_wait
+            while count < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(request)
+                count += len(request.items)
+
+            self._run_batch(batch)
+
+    def _run_model(self, inputs: List[Any]) -> List[Any]:
+        model = registry.get(self.name)
+        call = BATCHED_CALLS.get(self.name)
+        if call is not None:
+            return list(call(model, inputs))
+        return list(model(inputs))
+
+    def _run_batch(self, batch: List[_Request]):
+        segments = []
+        inputs: Dict[int, List[Any]] = {}
+        try:
+            for k, request in enumerate(batch):
+                try:
+                    request_inputs = []
+                    for item in request.items:
+                        if isinstance(item, tuple) and item[0] == "shm":
+                            # Map the client's image buffer without copying it
+                            _, shm_name, shape, dtype = item
+                            shm = _open_shared_memory(shm_name)
+                            segments.append(shm)
+                            array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+                            item = Image.fromarray(array)
+                        request_inputs.append(item)
+                    inputs[k] = request_inputs
+                except Exception as e:
+                    request.result = ("error", f"{type(e).__name__}: {e}")
+
+            all_inputs = [item for items in inputs.values() for item in items]
+            if not all_inputs:
+                return
+            try:
+                outputs = self._run_model(all_inputs)
+                start = 0
+                for k, request_inputs in inputs.items():
+                    end = start + len(request_inputs)
+                    batch[k].result = ("ok", outputs[start:end])
+                    start = end
+            except Exception as e:
+                if len(all_inputs) == 1:
+                    raise
+
+                # One bad input should only fail its own request, so the
+                # inputs are run again one at a time
+                logger.warning("Batch of %s failed, retrying one by one: %s", self.name, e)
+                for k, request_inputs in inputs.items():
+                    try:
+                        batch[k].result = (
+                            "ok",
+                            [self._run_model([item])[0] for item in request_inputs],
+                        )
+                    except Exception as e:
+                        batch[k].result = ("error", f"{type(e).__name__}: {e}")
+        except Exception as e:
+            for k in inputs:
+                batch[k].result = ("error", f"{type(e).__name__}: {e}")
+        finally:
+            inputs = all_inputs = request_inputs = array = item = None
+            for shm in segments:
+                try:
+                    shm.close()
+                except BufferError:
+                    # An image still views the buffer, it is unmapped once freed
+                    pass
+            for request in batch:
+                request.done.set()
+
+
+def serve(address: str) -> None:
+    """
+    Serves the registered models on a Unix socket until interrupted.
+    """
+    authkey = _require_authkey()
+    if os.path.exists(address):
+        os.remove(address)
+
+    batchers = {}
+    batchers_lock = threading.Lock()
+
+    def handle(conn):
+        with conn:
+            while True:
+                try:
+                    name, items = conn.recv()
+                except EOFError:
+                    return
+                with batchers_lock:
+                    if name not in batchers:
+                        batchers[name] = MicroBatcher(name)
+                conn.send(batchers[name](items))
+
+    with Listener(address, family="AF_UNIX", authkey=authkey) as listener:
+        # Only the user running the server may connect to the socket
+        os.chmod(address, 0o600)
+        logger.info("Model server listening on %s", address)
+        while True:
+            conn = listener.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+
+class RemoteModel:
+    """
+    Calls a model hosted by the model server. Each thread (Streamlit session)
+    uses its own connection so that their requests can be batched together.
+    """
+
+    def __init__(self, name: str, address: str):
+        self.name = name
+        self.address = address
+        self._local = threading.local()
+
+    def _connection(self):
+        if not hasattr(self._local, "conn"):
+            self._local.conn = Client(
+                self.address, family="AF_UNIX", authkey=_require_authkey()
+            )
+        return self._local.conn
+
+    def run(self, items: List[Any]) -> List[Any]:
+        """
+        Runs the model on a list of inputs. Images (PIL or NumPy) are passed
+        through shared memory.
+        """
+        segments, wire_items = [], []
+        try:
+            for item in items:
+                if isinstance(item, (Image.Image, np.ndarray)):
+                    array = np.asarray(item)
+                    shm = shared_memory.SharedMemory(
+                        create=True, size=max(array.nbytes, 1)
+                    )
+                    segments.append(shm)
+                    view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)
+                    view[...] = array
+                    del view
+                    item = ("shm", shm.name, array.shape, array.dtype.str)
+                wire_items.append(item)
+
+            conn = self._connection()
+            conn.send((self.name, wire_items))
+            status, result = conn.recv()
+        finally:
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+
+        if status == "error":
+            raise RuntimeError(f"Model server failed to run {self.name}: {result}")
+        return result
+
+    def __call__(self, inputs):
+        # Same calling convention as the local pipeline / embedding function:
+        # a single input gives a single output, a list gives a list
+        if isinstance(inputs, list):
+            return self.run(inputs)
+        return self.run([inputs])[0]
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
+    # The server loads the models itself rather than forwarding to another server
+    os.environ.pop("MODEL_SERVER_SOCKET", None)
+    serve(sys.argv[1] if len(sys.argv) > 1 else "/tmp/model_server.sock")
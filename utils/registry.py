@@ -0,0 +1,197 @@
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+# Set up logging.
+logger = logging.getLogger(__name__)
+
+# Loaders for heavy models and backends, keyed by name. Nothing here is
+# imported or built until `get` is called for the first time.
+_loaders: Dict[str, Callable[[], Any]] = {}
+
+# Loaded instances, shared by every Streamlit session in this process
+_instances: Dict[str, Any] = {}
+
+# One lock per name so that two slow loads do not block each other
+_locks: Dict[str, threading.Lock] = {}
+_registry_lock = threading.Lock()
+
+# Background thread started by `warm_up_once`
+_warm_up_thread: Optional[threading.Thread] = None
+
+
+def register(name: str, loader: Callable[[], Any]) -> None:
+    """
+    Registers a loader that builds a model or backend on first use.
+
+    Args:
+    name (str): The key the model is looked up by.
+    loader (Callable[[], Any]): A zero-argument function returning the model.
+    """
+    with _registry_lock:
+        _loaders[name] = loader
+        _locks.setdefault(name, threading.Lock())
+
+
+def get(name: str) -> Any:
+    """
+    Returns the model registered under `name`, loading it on the first call.
+
+    Args:
+    name (str): The key the model was registered under.
+
+    Returns:
+    Any: The loaded model, held once per process.
+    """
+    if name in _instances:
+        return _instances[name]
+
+    if name not in _loaders:
+        raise KeyError(f"No model registered under '{name}'.")
+
+    # Only one thread loads a given model, the others wait for it
+    with _locks[name]:
+        if name not in _instances:
+            _instances[name] = _loaders[name]()
+
+    return _instances[name]
+
+
+def is_loaded(name: str) -> bool:
+    """
+    Checks whether the model registered under `name` has been loaded.
+    """
+    return name in _instances
+
+
+def warm_up(names: Optional[Iterable[str]] = None) -> threading.Thread:
+    """
+    Loads the given models on a background thread.
+
+    Args:
+    names (Optional[Iterable[str]]): The models to load. Defaults to the
+    comma-separated list in the WARM_UP_MODELS environment variable.
+
+    Returns:
+    threading.Thread: The (daemon) thread doing the loading.
+    """
+    if names is None:
+        names = [n.strip() for n in os.environ.get("WARM_UP_MODELS", "").split(",")]
+    names = [n for n in names if n and not is_loaded(n)]
+
+    def _load_all():
+        for name in names:
+            try:
+                get(name)
+            except Exception as e:
+                logger.warning("Warm-up of %s failed: %s", name, e)
+
+    thread = threading.Thread(target=_load_all, name="model-warm-up", daemon=True)
+    thread.start()
+    return thread
+
+
+def warm_up_once() -> threading.Thread:
+    """
+    Starts the WARM_UP_MODELS background load once per process. Streamlit
+    re-executes the app script on every interaction, so the app calls this
+    instead of `warm_up` directly.
+    """
+    global _warm_up_thread
+    with _registry_lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = warm_up()
+    return _warm_up_thread
+
+
+# Default loaders. The imports live inside each loader so that importing this
+# module (and the app) stays cheap.
+def _remote_model(name):
+    # Use the shared model server (utils/model_server.py) when one is configured
+    address = os.environ.get("MODEL_SERVER_SOCKET")
+    if not address:
+        return None
+
+    from utils.model_server import RemoteModel
+
+    return RemoteModel(name, address)
+
+
+def _load_yolo():
+    remote = _remote_model("yolo")
+    if remote is not None:
+        return remote
+
+    from transformers import pipeline
+
+    return pipeline("object-detection", model="hustvl/yolos-small")
+
+
+def _load_embedding_function():
+    remote = _remote_model("embedding_function")
+    if remote is not None:
+        return remote
+
+    from chromadb.utils.embedding_functions import (
+        SentenceTransformerEmbeddingFunction,
+    )
+
+    return SentenceTransformerEmbeddingFunction()
+
+
+def _load_caption():
+    remote = _remote_model("caption")
+    if remote is not None:
+        return remote
+
+    from utils.cnn_transformer import Captioner, load_caption_model
+
+    return Captioner(load_caption_model())
+
+
+def _load_character_splitter():
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    return RecursiveCharacterTextSplitter(
+        separators=["\n\n", "\n", ". ", " ", ""], chunk_size=1000, chunk_overlap=0
+    )
+
+
+def _load_token_splitter():
+    from langchain.text_splitter import SentenceTransformersTokenTextSplitter
+
+    return SentenceTransformersTokenTextSplitter(chunk_overlap=0, tokens_per_chunk=256)
+
+
+def _load_palm():
+    import google.generativeai as palm
+    import streamlit as st
+
+    # API Key (You should set this in your environment variables)
+    palm.configure(api_key=st.secrets["PALM_API_KEY"])
+    return palm
+
+
+def _load_gemini_batcher():
+    import streamlit as st
+
+    from utils.gemini_batch import GeminiBatcher
+
+    return GeminiBatcher(api_key=st.secrets["PALM_API_KEY"])
+
+
+def _load_corpus():
+    from utils.corpus import CorpusManager
+
+    return CorpusManager()
+
+
+register("yolo", _load_yolo)
+register("embedding_function", _load_embedding_function)
+register("caption", _load_caption)
+register("character_splitter", _load_character_splitter)
+register("token_splitter", _load_token_splitter)
+register("palm", _load_palm)
+register("gemini_batcher", _load_gemini_batcher)
+register("corpus", _load_corpus)
@@ -0,0 +1,217 @@
+import logging
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+from PIL import Image
+
+from utils.frame_cache import dhash
+
+# Set up logging.
+logger = logging.getLogger(__name__)
+
+# Hamming distance from the last keyframe above which a frame is a new keyframe
+KEYFRAME_THRESHOLD = 12
+
+# Minimum number of seconds between two keyframes sent to Gemini
+KEYFRAME_MIN_INTERVAL = 2.0
+
+# Color and width of the box outlines drawn on the frames
+BOX_COLOR = (255, 0, 0)
+BOX_WIDTH = 2
+
+
+def boxes_to_array(predictions: List[Dict[str, Any]]) -> np.ndarray:
+    """
+    Converts YOLO pipeline predictions to an (N, 4) array of xmin, ymin, xmax, ymax.
+    """
+    if not predictions:
+        return np.empty((0, 4), dtype=np.int64)
+    return np.array(
+        [
+            [p["box"]["xmin"], p["box"]["ymin"], p["box"]["xmax"], p["box"]["ymax"]]
+            for p in predictions
+        ],
+        dtype=np.int64,
+    )
+
+
+def overlay_boxes(
+    frame: np.ndarray,
+    boxes: np.ndarray,
+    color=BOX_COLOR,
+    width: int = BOX_WIDTH,
+) -> np.ndarray:
+    """
+    Draws the outlines of all boxes on a frame in one vectorized pass.
+
+    Args:
+    frame (np.ndarray): The (H, W, 3) uint8 frame, modified in place.
+    boxes (np.ndarray): The (N, 4) boxes as xmin, ymin, xmax, ymax.
+    color: The RGB color of the outlines.
+    width (int): The width of the outlines in pixels.
+
+    Returns:
+    np.ndarray: The annotated frame.
+    """
+    if len(boxes) == 0:
+        return frame
+
+    height, frame_width = frame.shape[:2]
+    xmin, ymin, xmax, ymax = boxes.T[:, :, np.newaxis]
+    ys = np.arange(height)[np.newaxis, :]
+    xs = np.arange(frame_width)[np.newaxis, :]
+
+    # (N, H) and (N, W) memberships of each box and of its edges
+    rows_in = (ys >= ymin) & (ys <= ymax)
+    cols_in = (xs >= xmin) & (xs <= xmax)
+    rows_edge = rows_in & ((ys < ymin + width) | (ys > ymax - width))
+    cols_edge = cols_in & ((xs < xmin + width) | (xs > xmax - width))
+
+    # A pixel is on an outline if, for some box, it is on a horizontal edge
+    # and inside the columns, or on a vertical edge and inside the rows
+    mask = (
+        rows_edge.T.astype(np.float32) @ cols_in.astype(np.float32)
+        + rows_in.T.astype(np.float32) @ cols_edge.astype(np.float32)
+    ) > 0
+    frame[mask] = color
+    return frame
+
+
+class LatestFrameWorker:
+    """
+    Runs `process` on a background thread, always on the most recent frame.
+    Frames submitted while the worker is busy replace each other, so stale
+    frames are dropped instead of queued and latency stays bounded.
+    """
+
+    def __init__(self, process: Callable[[Any], Any]):
+        self.process = process
+        self.result: Any = None
+        self.dropped = 0
+        self.latency = 0.0
+        self._frame: Any = None
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(
+            target=self._run, name="latest-frame-worker", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, frame: Any) -> None:
+        """
+        Hands a frame to the worker, replacing any frame not yet processed.
+        """
+        with self._condition:
+            if self._frame is not None:
+                self.dropped += 1
+            self._frame = frame
+            self._condition.notify()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._frame is None and not self._stopped:
+                    self._condition.wait()
+                if self._stopped:
+                    return
+                frame, self._frame = self._frame, None
+
+            start = time.monotonic()
+            try:
+                self.result = self.process(frame)
+            except Exception as e:
+                logger.warning("Frame processing failed: %s", e)
+            self.latency = time.monotonic() - start
+
+
+class KeyframeDetector:
+    """
+    Flags a frame as a keyframe when it differs enough (by dHash) from the
+    last keyframe and enough time has passed since it.
+    """
+
+    def __init__(
+        self,
+        threshold: int = KEYFRAME_THRESHOLD,
+        min_interval: float = KEYFRAME_MIN_INTERVAL,
+    ):
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self._last_hash: Optional[int] = None
+        self._last_time = 0.0
+
+    def is_keyframe(self, image: Image.Image) -> bool:
+        now = time.monotonic()
+        if now - self._last_time < self.min_interval:
+            return False
+
+        frame_hash = dhash(image)
+        if self._last_hash is not None:
+            distance = bin(frame_hash ^ self._last_hash).count("1")
+            if distance <= self.threshold:
+                return False
+
+        self._last_hash = frame_hash
+        self._last_time = now
+        return True
+
+
+class LiveAnalyzer:
+    """
+    Analyses a live camera stream: YOLO runs on the latest frame on a
+    background worker and Gemini is asked about keyframes only.
+    """
+
+    def __init__(
+        self,
+        detect: Callable[[Image.Image], List[Dict[str, Any]]],
+        describe: Optional[Callable[[Image.Image], Future]] = None,
+    ):
+        self.describe = describe
+        self.keyframes = KeyframeDetector()
+        self.description: Optional[Dict[str, Any]] = None
+        self._pending: Optional[Future] = None
+        self._detect = detect
+        self.detector = LatestFrameWorker(self._run_detection)
+
+    def _run_detection(self, image: Image.Image):
+        predictions = self._detect(image)
+        return boxes_to_array(predictions), predictions
+
+    def __call__(self, frame: np.ndarray) -> np.ndarray:
+        """
+        Processes one RGB frame and returns it annotated with the latest boxes.
+        """
+        image = Image.fromarray(frame)
+        self.detector.submit(image)
+
+        if self.describe is not None:
+            if self._pending is not None and self._pending.done():
+                if self._pending.exception() is None:
+                    self.description = self._pending.result()
+                self._pending = None
+            if self._pending is None and self.keyframes.is_keyframe(image):
+                self._pending = self.describe(image)
+
+        # Boxes come from the most recent detection, which may lag one frame
+        if self.detector.result is None:
+            return frame
+        boxes, _ = self.detector.result
+        return overlay_boxes(frame.copy(), boxes)
+
+    @property
+    def predictions(self) -> List[Dict[str, Any]]:
+        if self.detector.result is None:
+            return []
+        return self.detector.result[1]
+
+    def stop(self) -> None:
+        self.detector.stop()
@@ -0,0 +1,283 @@
+import base64
+import gzip
+import json
+import time
+import uuid
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import requests
+
+
+def post_request_and_parse_response(
+    url: str, payload: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    Sends a POST request to the specified URL with the given payload,
+    then parses the byte response to a dictionary.
+
+    Args:
+    url (str): The URL to which the POST request is sent.
+    payload (Dict[str, Any]): The payload to send in the POST request.
+
+    Returns:
+    Dict[str, Any]: The parsed dictionary from the response.
+    """
+    # Set headers for the POST request
+    headers = {"Content-Type": "application/json"}
+
+    # Send the POST request and get the response
+    response = requests.post(url, json=payload, headers=headers)
+
+    # Extract the byte data from the response
+    byte_data = response.content
+
+    # Decode the byte data to a string
+    decoded_string = byte_data.decode("utf-8")
+
+    # Convert the JSON string to a dictionary
+    dict_data = json.loads(decoded_string)
+
+    return dict_data
+
+
+def extract_line_items(input_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    Extracts items with "BlockType": "LINE" from the provided JSON data.
+
+    Args:
+    input_data (Dict[str, Any]): The input JSON data as a dictionary.
+
+    Returns:
+    List[Dict[str, Any]]: A list of dictionaries with the extracted data.
+    """
+    # Initialize an empty list to hold the extracted line items
+    line_items: List[Dict[str, Any]] = []
+
+    # Get the list of items from the 'body' key in the input data
+    body_items = json.loads(input_data.get("body", "[]"))
+
+    # Iterate through each item in the body
+    for item in body_items:
+        # Check if the BlockType of the item is 'LINE'
+        if item.get("BlockType") == "LINE":
+            # Add the item to the line_items list
+            line_items.append(item)
+
+    return line_items
+
+
+# Projection sent to the Textract Lambda: only LINE blocks and the fields we display
+TEXTRACT_LINE_PROJECTION = {
+    "block_types": ["LINE"],
+    "fields": ["Text", "Confidence", "BoundingBox"],
+}
+
+
+# Projection fields decoded as float32 columns, all others are kept as objects
+TEXTRACT_NUMERIC_FIELDS = {
+    "Confidence",
+    "Page",
+    "RowIndex",
+    "ColumnIndex",
+    "RowSpan",
+    "ColumnSpan",
+}
+
+
+def decode_columnar_response(input_data: Dict[str, Any]) -> pd.DataFrame:
+    """
+    Decodes a columnar (optionally gzip-compressed) Textract Lambda response
+    straight into a DataFrame with one NumPy array per column.
+
+    Args:
+    input_data (Dict[str, Any]): The parsed response of the Lambda, sent with a
+    projection (see TEXTRACT_LINE_PROJECTION).
+
+    Returns:
+    pd.DataFrame: One row per projected block.
+    """
+    # API Gateway errors (e.g. "Request Too Long", "Endpoint request timed
+    # out") come back as {"message"} without the Lambda's statusCode and body
+    if "statusCode" not in input_data or "body" not in input_data:
+        message = input_data.get("message", input_data)
+        raise RuntimeError(f"Textract request failed: {message}")
+
+    # Errors of the Lambda come back as {"Error", "ErrorMessage"} with a 400
+    body = input_data["body"]
+    if input_data["statusCode"] != 200:
+        message = body.get("ErrorMessage", body) if isinstance(body, dict) else body
+        raise RuntimeError(f"Textract request failed: {message}")
+
+    # A Lambda without projection support still returns every Block as a string
+    if isinstance(body, str):
+        return pd.DataFrame(extract_line_items(input_data))
+
+    if body.get("encoding") == "gzip":
+        columns = json.loads(gzip.decompress(base64.b64decode(body["data"])))
+    else:
+        columns = body.get("columns", {})
+
+    arrays = {}
+    for name, values in columns.items():
+        if name in TEXTRACT_NUMERIC_FIELDS or name.startswith("BoundingBox."):
+            arrays[name] = np.asarray(values, dtype=np.float32)
+        else:
+            # Strings, lists (e.g. Relationships) and anything else stay objects,
+            # one per row even when the values are equal-length lists
+            arrays[name] = np.empty(len(values), dtype=object)
+            arrays[name][:] = values
+
+    return pd.DataFrame(arrays, copy=False)
+
+
+# Largest event a synchronous Lambda invocation accepts. API Gateway puts the
+# request body into the event base64 encoded, next to the headers and the rest
+LAMBDA_PAYLOAD_LIMIT = 6 * 1000 * 1000
+
+# Documents up to this size (about 4.3 MB) fit in the event and are posted to
+# the Textract Lambda directly; larger ones must go through S3
+TEXTRACT_BINARY_LIMIT = (LAMBDA_PAYLOAD_LIMIT - 256 * 1024) * 3 // 4
+
+# Seconds between two polls of an asynchronous Textract job
+TEXTRACT_POLL_INTERVAL = 2.0
+
+# Seconds after which polling an asynchronous Textract job is given up
+TEXTRACT_POLL_TIMEOUT = 600.0
+
+# Lambda URLs whose API Gateway does not accept binary bodies; these get
+# base64 JSON instead
+_textract_binary_unsupported = set()
+
+
+def post_binary_document(
+    url: str,
+    document_bytes: bytes,
+    content_type: str,
+    projection: Optional[Dict[str, Any]],
+    compress: bool,
+    run_async: bool,
+) -> Optional[Dict[str, Any]]:
+    """
+    Posts a document to the Textract Lambda as a raw binary body, with the
+    options in the query string.
+
+    Returns:
+    Optional[Dict[str, Any]]: The parsed response, or None when the Lambda
+    reports a BinaryBodyError, i.e. the API Gateway does not pass binary bodies
+    through. Other gateway errors are returned as they are.
+    """
+    params = {"compress": str(compress).lower(), "async": str(run_async).lower()}
+    if projection is not None:
+        for key in ("block_types", "fields"):
+            if projection.get(key):
+                params[key] = ",".join(projection[key])
+
+    response = requests.post(
+        url,
+        data=document_bytes,
+        params=params,
+        headers={"Content-Type": content_type},
+    )
+    try:
+        result_dict = json.loads(response.content.decode("utf-8"))
+    except ValueError:
+        raise RuntimeError(
+            f"Textract request failed with HTTP status {response.status_code}."
+        )
+
+    # Only a body the gateway mangled into text means binary is unsupported;
+    # gateway errors (413, 502, 504, ...) are left to the caller
+    body = result_dict.get("body")
+    if isinstance(body, dict) and body.get("Error") == "BinaryBodyError":
+        return None
+    return result_dict
+
+
+def textract_document(
+    url: str,
+    document_bytes: bytes,
+    content_type: str = "image/jpeg",
+    projection: Optional[Dict[str, Any]] = TEXTRACT_LINE_PROJECTION,
+    compress: bool = True,
+    multi_page: bool = False,
+    s3_bucket: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    Sends a document to the Textract Lambda through the cheapest route for its
+    size: a raw binary body for small documents (base64 JSON when the API
+    Gateway does not accept binary bodies), otherwise an S3 reference uploaded
+    here to `s3_bucket`. Multi-page documents and S3 references are analyzed by
+    an asynchronous job that is polled until it finishes or
+    TEXTRACT_POLL_TIMEOUT is reached.
+
+    Args:
+    url (str): The URL of the Textract Lambda.
+    document_bytes (bytes): The image or PDF content.
+    content_type (str): The MIME type of the document.
+    projection (Optional[Dict[str, Any]]): Block types and fields to return.
+    compress (bool): Whether the Lambda should gzip the columnar response.
+    multi_page (bool): Whether the document may have several pages, which
+    requires an asynchronous job.
+    s3_bucket (Optional[str]): Bucket to upload large documents to. Required
+    for documents over TEXTRACT_BINARY_LIMIT, which do not fit in the Lambda
+    event.
+
+    Returns:
+    Dict[str, Any]: The parsed response, as for post_request_and_parse_response.
+    """
+    options: Dict[str, Any] = {"compress": compress}
+    if projection is not None:
+        options["projection"] = projection
+
+    is_large = len(document_bytes) > TEXTRACT_BINARY_LIMIT
+    if is_large and s3_bucket is None:
+        raise ValueError(
+            f"Document of {len(document_bytes)} bytes does not fit through the API "
+            f"Gateway (limit {TEXTRACT_BINARY_LIMIT} bytes). Pass an s3_bucket."
+        )
+
+    if (is_large or multi_page) and s3_bucket is not None:
+        # Upload straight to S3 and only send the reference through the API
+        import boto3
+
+        name = f"textract-uploads/{uuid.uuid4()}"
+        boto3.client("s3").put_object(Bucket=s3_bucket, Key=name, Body=document_bytes)
+        payload = {"S3Object": {"Bucket": s3_bucket, "Name": name}, "async": True}
+        result_dict = post_request_and_parse_response(url, {**payload, **options})
+    else:
+        result_dict = None
+        if url not in _textract_binary_unsupported:
+            result_dict = post_binary_document(
+                url,
+                document_bytes,
+                content_type,
+                projection,
+                compress,
+                run_async=multi_page,
+            )
+            if result_dict is None:
+                _textract_binary_unsupported.add(url)
+
+        if result_dict is None:
+            # Base64 JSON, which works without binary media types on the gateway
+            payload = {
+                "image": base64.b64encode(document_bytes).decode("utf-8"),
+                "async": multi_page,
+            }
+            result_dict = post_request_and_parse_response(url, {**payload, **options})
+
+    # Poll the asynchronous job until the Lambda returns its blocks
+    deadline = time.monotonic() + TEXTRACT_POLL_TIMEOUT
+    while result_dict.get("statusCode") == 202:
+        if time.monotonic() > deadline:
+            raise TimeoutError(
+                f"Textract job {result_dict['body']['JobId']} did not finish "
+                f"within {TEXTRACT_POLL_TIMEOUT:.0f} seconds."
+            )
+        time.sleep(TEXTRACT_POLL_INTERVAL)
+        payload = {"JobId": result_dict["body"]["JobId"]}
+        result_dict = post_request_and_parse_response(url, {**payload, **options})
+
+    return result_dict